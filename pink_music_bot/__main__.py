@@ -1,16 +1,27 @@
 import asyncio
 import logging
+import multiprocessing
 
 from .bot import PinkMusicBot
+from .constants import BotMode
 from .config import (
     admin_user_id,
     api_hash,
     api_id,
     api_language,
+    bot_mode,
     bot_token,
+    chat_rate_limit,
+    cover_cache_disk_size,
+    cover_cache_path,
+    cover_cache_size,
     credit_api_url,
     database_url,
+    download_disk_budget,
+    download_min_free_space,
+    download_pipeline_size,
     download_timeout,
+    download_workers,
     downloader_amdecrypt_path,
     downloader_cover_format,
     downloader_cover_size,
@@ -30,22 +41,37 @@ from .config import (
     downloader_temp_path,
     downloader_truncate,
     downloader_wrapper_decrypt_ip,
+    fair_scheduling,
     force_english,
+    free_credits_refresh_interval,
     free_daily_credits,
+    helper_bot_tokens,
     kofi_shop_id,
     kofi_url,
     kofi_verification_token,
     max_concurrent_transmissions,
     media_user_tokens,
+    metadata_cache_size,
+    metadata_cache_ttl,
     music_video_cache_id,
+    music_video_size_margin,
+    priority_aging_interval,
+    rate_limit,
     song_cache_chat_id,
+    upload_connections,
+    user_cache_size,
+    user_cache_ttl,
+    user_counters_flush_interval,
+    worker_processes,
     wrapper_account_url,
+    wrapper_concurrency,
+    wrapper_health_check_interval,
 )
 
 logger = logging.getLogger(__package__)
 
 
-async def main():
+async def main(worker_index: int = 0):
     logging.getLogger("pyrogram").setLevel(logging.ERROR)
     logging.basicConfig(
         format="[%(asctime)s - %(levelname)s - %(name)s] %(message)s",
@@ -56,10 +82,18 @@ async def main():
         api_id=api_id,
         api_hash=api_hash,
         bot_token=bot_token,
+        helper_bot_tokens=helper_bot_tokens,
+        bot_mode=bot_mode,
+        worker_index=worker_index,
         max_concurrent_transmissions=max_concurrent_transmissions,
+        upload_connections=upload_connections,
         database_url=database_url,
+        user_cache_size=user_cache_size,
+        user_cache_ttl=user_cache_ttl,
+        user_counters_flush_interval=user_counters_flush_interval,
         force_english=force_english,
         free_daily_credits=free_daily_credits,
+        free_credits_refresh_interval=free_credits_refresh_interval,
         admin_user_id=admin_user_id,
         media_user_tokens=media_user_tokens,
         wrapper_account_url=wrapper_account_url,
@@ -69,8 +103,24 @@ async def main():
         kofi_shop_id=kofi_shop_id,
         kofi_url=kofi_url,
         download_timeout=download_timeout,
+        download_pipeline_size=download_pipeline_size,
+        download_workers=download_workers,
+        download_disk_budget=download_disk_budget,
+        download_min_free_space=download_min_free_space,
+        cover_cache_size=cover_cache_size,
+        cover_cache_path=cover_cache_path,
+        cover_cache_disk_size=cover_cache_disk_size,
+        metadata_cache_ttl=metadata_cache_ttl,
+        metadata_cache_size=metadata_cache_size,
+        fair_scheduling=fair_scheduling,
+        priority_aging_interval=priority_aging_interval,
+        rate_limit=rate_limit,
+        chat_rate_limit=chat_rate_limit,
+        wrapper_concurrency=wrapper_concurrency,
+        wrapper_health_check_interval=wrapper_health_check_interval,
         song_cache_chat_id=song_cache_chat_id,
         music_video_cache_chat_id=music_video_cache_id,
+        music_video_size_margin=music_video_size_margin,
         downloader_temp_path=downloader_temp_path,
         downloader_ffmpeg_path=downloader_ffmpeg_path,
         downloader_mp4box_path=downloader_mp4box_path,
@@ -93,4 +143,19 @@ async def main():
     )
 
 
-asyncio.run(main())
+def run(worker_index: int = 0) -> None:
+    asyncio.run(main(worker_index))
+
+
+if __name__ == "__main__":
+    if bot_mode == BotMode.WORKER and worker_processes > 1:
+        processes = [
+            multiprocessing.Process(target=run, args=(worker_index,))
+            for worker_index in range(worker_processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    else:
+        run()
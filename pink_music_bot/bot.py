@@ -1,34 +1,63 @@
 import asyncio
 import datetime
 import logging
+import re
+import shutil
+import socket
 from pathlib import Path
-from typing import Callable
+from typing import Awaitable, Callable
 
 from gamdl.api import AppleMusicApi, ItunesApi
 from gamdl.downloader import CoverFormat, DownloadMode, RemuxFormatMusicVideo, RemuxMode
 from gamdl.interface import AppleMusicInterface, SyncedLyricsFormat
-from pyrogram import Client
 from pyrogram.methods.utilities.idle import idle
 from pyrogram.types import Message
 
-from .database import Database
+from .constants import BotMode
+from .cover_cache import CoverCache
+from .database import Database, DownloadJob, User
+from .disk_admission import DiskAdmission
+from .download_job_queue import DownloadJobQueue
 from .locale_parser import LocaleParser
+from .metadata_cache import MetadataCache
 from .priority_semaphore import PrioritySemaphore
+from .rate_limiter import RateLimiter
+from .single_flight import SingleFlight
+from .upload_client import UploadClient
+from .upload_pool import UploadPool
 from .user_locker import UserLocker
+from .wrapper_pool import WrapperPool
 
 logger = logging.getLogger(__name__)
 
+FILE_ID_BACKFILL_BATCH_SIZE = 100
+DOWNLOAD_JOB_POLL_INTERVAL = 2
+# Claims that were not renewed for this long belong to a dead process
+DOWNLOAD_JOB_LEASE = 120
+PROCESS_TEMP_PATH_PATTERN = re.compile(
+    rf"^({'|'.join(bot_mode.value for bot_mode in BotMode)})_\d+$"
+)
+
+
+class PinkMusicBot(UploadClient):
+    download_batch_handler: (
+        Callable[["PinkMusicBot", list[DownloadJob]], Awaitable[None]] | None
+    ) = None
 
-class PinkMusicBot(Client):
     def __init__(
         self,
         api_id: int,
         api_hash: str,
         bot_token: str,
+        bot_mode: BotMode,
+        worker_index: int,
         max_concurrent_transmissions: int,
+        upload_connections: int,
+        helper_clients: list[UploadClient],
         db: Database,
         lp: LocaleParser,
         free_daily_credits: int,
+        free_credits_refresh_interval: int,
         admin_user_id: int,
         apple_music_interfaces: dict[str, AppleMusicInterface],
         apple_music_wrapper_interface: AppleMusicInterface,
@@ -39,10 +68,20 @@ class PinkMusicBot(Client):
         user_locker: UserLocker,
         upload_priority_semaphore: PrioritySemaphore,
         download_priority_semaphore: PrioritySemaphore,
-        wrapper_locker: asyncio.Lock,
+        wrapper_pool: WrapperPool,
+        single_flight: SingleFlight,
+        rate_limiter: RateLimiter,
+        download_job_queue: DownloadJobQueue,
+        disk_admission: DiskAdmission,
+        cover_cache: CoverCache,
+        metadata_cache: MetadataCache,
         download_timeout: int,
+        download_pipeline_size: int,
+        download_workers: int,
+        user_counters_flush_interval: float,
         song_cache_chat_id: int,
         music_video_cache_chat_id: int,
+        music_video_size_margin: float,
         # Downloader params
         downloader_temp_path: str,
         downloader_ffmpeg_path: str,
@@ -50,7 +89,7 @@ class PinkMusicBot(Client):
         downloader_mp4decrypt_path: str,
         downloader_nm3u8dlre_path: str,
         downloader_amdecrypt_path: str,
-        downloader_wrapper_decrypt_ip: str,
+        downloader_wrapper_decrypt_ip: list[str],
         downloader_download_mode: DownloadMode,
         downloader_remux_mode: RemuxMode,
         downloader_cover_format: CoverFormat,
@@ -64,8 +103,14 @@ class PinkMusicBot(Client):
         downloader_synced_lyrics_format: SyncedLyricsFormat,
         downloader_music_video_remux_format: RemuxFormatMusicVideo,
     ) -> None:
+        # Worker processes only run download jobs, so they use their own
+        # session and leave updates to the frontend
         super().__init__(
-            name=__package__,
+            name=(
+                f"{__package__}_worker_{worker_index}"
+                if bot_mode == BotMode.WORKER
+                else __package__
+            ),
             api_id=api_id,
             api_hash=api_hash,
             bot_token=bot_token,
@@ -73,10 +118,19 @@ class PinkMusicBot(Client):
             workers=1200,
             max_concurrent_transmissions=max_concurrent_transmissions,
             sleep_threshold=60,
+            no_updates=bot_mode == BotMode.WORKER,
+            upload_connections=upload_connections,
+        )
+        self.bot_mode = bot_mode
+        self.helper_clients = helper_clients
+        self.upload_pool = UploadPool([self, *helper_clients])
+        self.download_worker_prefix = (
+            f"{socket.gethostname()}:{bot_mode.value}:{worker_index}:"
         )
         self.db = db
         self.lp = lp
         self.free_daily_credits = free_daily_credits
+        self.free_credits_refresh_interval = free_credits_refresh_interval
         self.admin_user_id = admin_user_id
         self.apple_music_interfaces = apple_music_interfaces
         self.apple_music_wrapper_interface = apple_music_wrapper_interface
@@ -87,12 +141,26 @@ class PinkMusicBot(Client):
         self.user_locker = user_locker
         self.upload_priority_semaphore = upload_priority_semaphore
         self.download_priority_semaphore = download_priority_semaphore
-        self.wrapper_locker = wrapper_locker
+        self.wrapper_pool = wrapper_pool
+        self.single_flight = single_flight
+        self.rate_limiter = rate_limiter
+        self.download_job_queue = download_job_queue
+        self.disk_admission = disk_admission
+        self.cover_cache = cover_cache
+        self.metadata_cache = metadata_cache
         self.download_timeout = download_timeout
+        self.download_pipeline_size = download_pipeline_size
+        self.download_workers = download_workers
+        self.user_counters_flush_interval = user_counters_flush_interval
         self.song_cache_chat_id = song_cache_chat_id
         self.music_video_cache_chat_id = music_video_cache_chat_id
+        self.music_video_size_margin = music_video_size_margin
         # Downloader params
-        self.downloader_temp_path = downloader_temp_path
+        # Each process stages downloads in its own directory so orphaned
+        # files can be swept at startup without touching other processes
+        self.downloader_temp_path = str(
+            Path(downloader_temp_path) / f"{bot_mode.value}_{worker_index}"
+        )
         self.downloader_ffmpeg_path = downloader_ffmpeg_path
         self.downloader_mp4box_path = downloader_mp4box_path
         self.downloader_mp4decrypt_path = downloader_mp4decrypt_path
@@ -117,10 +185,26 @@ class PinkMusicBot(Client):
         cls,
         max_concurrent_transmissions: int,
         database_url: str,
+        user_cache_size: int,
+        user_cache_ttl: int,
         force_english: bool,
         media_user_tokens: list[int],
         wrapper_account_url: str,
         api_language: str,
+        fair_scheduling: bool,
+        priority_aging_interval: float,
+        rate_limit: float,
+        chat_rate_limit: float,
+        wrapper_concurrency: int,
+        wrapper_health_check_interval: int,
+        download_disk_budget: int,
+        download_min_free_space: int,
+        cover_cache_size: int,
+        cover_cache_path: str | None,
+        cover_cache_disk_size: int,
+        metadata_cache_ttl: int,
+        metadata_cache_size: int,
+        helper_bot_tokens: list[str],
         **kwargs,
     ) -> None:
         lp = LocaleParser(
@@ -129,9 +213,16 @@ class PinkMusicBot(Client):
         )
 
         logger.info("Starting database")
-        db = await Database.create(database_url)
+        # Frontend and worker processes write the same users, and a process
+        # only invalidates its own cache on writes
+        db = await Database.create(
+            database_url,
+            user_cache_size if kwargs["bot_mode"] == BotMode.ALL else 0,
+            user_cache_ttl,
+        )
 
         logger.info("Starting Apple Music interfaces")
+        metadata_cache = MetadataCache(metadata_cache_ttl, metadata_cache_size)
         apple_music_interfaces = {}
         for media_user_token in media_user_tokens:
             try:
@@ -140,6 +231,7 @@ class PinkMusicBot(Client):
                     language=api_language,
                 )
                 assert apple_music_api.active_subscription
+                metadata_cache.wrap(apple_music_api)
 
                 itunes_api = ItunesApi(
                     storefront=apple_music_api.storefront,
@@ -161,6 +253,7 @@ class PinkMusicBot(Client):
                 wrapper_account_url=wrapper_account_url,
                 language=api_language,
             )
+            metadata_cache.wrap(apple_music_wrapper_api)
             itunes_wrapper_api = ItunesApi(
                 storefront=apple_music_wrapper_api.storefront,
                 language=api_language,
@@ -172,56 +265,393 @@ class PinkMusicBot(Client):
         else:
             apple_music_wrapper_interface = None
 
+        # Helper bots are members of the cache chats and only upload, the
+        # frontend never uploads so it does not need them
+        helper_clients = []
+        if kwargs["bot_mode"] != BotMode.FRONTEND:
+            for index, helper_bot_token in enumerate(helper_bot_tokens):
+                helper_clients.append(
+                    UploadClient(
+                        name=(
+                            f"{__package__}_helper_{index}_worker_"
+                            f"{kwargs['worker_index']}"
+                            if kwargs["bot_mode"] == BotMode.WORKER
+                            else f"{__package__}_helper_{index}"
+                        ),
+                        api_id=kwargs["api_id"],
+                        api_hash=kwargs["api_hash"],
+                        bot_token=helper_bot_token,
+                        max_concurrent_transmissions=max_concurrent_transmissions,
+                        # Helpers only upload through the rate limiter
+                        sleep_threshold=0,
+                        no_updates=True,
+                        upload_connections=kwargs["upload_connections"],
+                    )
+                )
+
         logger.info("Starting bot")
         bot = cls(
             max_concurrent_transmissions=max_concurrent_transmissions,
+            helper_clients=helper_clients,
             db=db,
             lp=lp,
             apple_music_interfaces=apple_music_interfaces,
             apple_music_wrapper_interface=apple_music_wrapper_interface,
             user_locker=UserLocker(),
-            upload_priority_semaphore=PrioritySemaphore(max_concurrent_transmissions),
-            download_priority_semaphore=PrioritySemaphore(max_concurrent_transmissions),
-            wrapper_locker=asyncio.Lock(),
+            upload_priority_semaphore=PrioritySemaphore(
+                max_concurrent_transmissions * (1 + len(helper_clients)),
+                fair_scheduling,
+                priority_aging_interval,
+            ),
+            download_priority_semaphore=PrioritySemaphore(
+                max_concurrent_transmissions,
+                fair_scheduling,
+                priority_aging_interval,
+            ),
+            wrapper_pool=WrapperPool(
+                kwargs["downloader_wrapper_decrypt_ip"],
+                wrapper_concurrency,
+                wrapper_health_check_interval,
+            ),
+            single_flight=SingleFlight(),
+            rate_limiter=RateLimiter(rate_limit, chat_rate_limit),
+            download_job_queue=DownloadJobQueue(),
+            disk_admission=DiskAdmission(
+                kwargs["downloader_temp_path"],
+                download_disk_budget,
+                download_min_free_space,
+            ),
+            cover_cache=CoverCache(
+                cover_cache_size,
+                cover_cache_path,
+                cover_cache_disk_size,
+            ),
+            metadata_cache=metadata_cache,
             **kwargs,
         )
+        background_tasks = []
+        started_helper_clients = []
         try:
+            # Swept before the handlers start, which stage their downloads
+            # in the same directory
+            if bot.bot_mode != BotMode.FRONTEND:
+                bot.sweep_temp_path()
             await bot.start()
             logger.info("Bot started")
+            background_tasks.append(asyncio.create_task(bot.flush_user_counters()))
+            for helper_client in helper_clients:
+                await helper_client.start()
+                started_helper_clients.append(helper_client)
+            if helper_clients:
+                logger.info(f"Started {len(helper_clients)} helper bots")
+            if bot.bot_mode != BotMode.WORKER:
+                background_tasks.append(
+                    asyncio.create_task(bot.backfill_cache_file_ids())
+                )
+                if bot.free_credits_refresh_interval:
+                    background_tasks.append(
+                        asyncio.create_task(bot.refresh_free_credits())
+                    )
+            if bot.bot_mode != BotMode.FRONTEND:
+                background_tasks.append(
+                    asyncio.create_task(bot.wrapper_pool.run_health_checks())
+                )
+                background_tasks.append(
+                    asyncio.create_task(bot.run_download_workers())
+                )
             await idle()
         finally:
+            for background_task in background_tasks:
+                background_task.cancel()
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+            try:
+                await bot.db.user.flush_counters()
+            except Exception:
+                logger.exception("Failed to flush user counters")
+            for helper_client in started_helper_clients:
+                await helper_client.stop()
             await bot.stop()
 
+    @classmethod
+    def on_download_batch(
+        cls,
+        func: Callable[["PinkMusicBot", list[DownloadJob]], Awaitable[None]],
+    ) -> Callable[["PinkMusicBot", list[DownloadJob]], Awaitable[None]]:
+        cls.download_batch_handler = func
+        return func
+
+    def sweep_temp_path(self) -> None:
+        temp_path = Path(self.downloader_temp_path)
+        orphaned_paths = []
+        # Entries of the shared temp path other than the process directories
+        # are left over from before processes had their own directory
+        if temp_path.parent.exists():
+            orphaned_paths.extend(
+                path
+                for path in temp_path.parent.iterdir()
+                if not PROCESS_TEMP_PATH_PATTERN.match(path.name)
+            )
+        if temp_path.exists():
+            orphaned_paths.extend(temp_path.iterdir())
+
+        for orphaned_path in orphaned_paths:
+            if orphaned_path.is_dir():
+                shutil.rmtree(orphaned_path, ignore_errors=True)
+            else:
+                orphaned_path.unlink(missing_ok=True)
+        if orphaned_paths:
+            logger.info(f"Swept {len(orphaned_paths)} orphaned temp paths")
+
+        temp_path.mkdir(parents=True, exist_ok=True)
+
+    async def run_download_workers(self) -> None:
+        # Jobs this process claimed before a restart were never finished, so
+        # they are handed back to the workers
+        released_download_jobs = await self.db.download_job.release(
+            self.download_worker_prefix
+        )
+        if released_download_jobs:
+            logger.info(f"Resuming {released_download_jobs} download jobs")
+
+        await asyncio.gather(
+            self.renew_download_job_lease(),
+            *(
+                self.run_download_worker(f"{self.download_worker_prefix}{i}")
+                for i in range(self.download_workers)
+            ),
+        )
+
+    async def renew_download_job_lease(self) -> None:
+        while True:
+            await asyncio.sleep(DOWNLOAD_JOB_LEASE / 4)
+            try:
+                await self.db.download_job.renew(self.download_worker_prefix)
+                released_download_jobs = await self.db.download_job.release_expired(
+                    datetime.datetime.now()
+                    - datetime.timedelta(seconds=DOWNLOAD_JOB_LEASE)
+                )
+            except Exception:
+                logger.exception("Failed to renew download job lease")
+                continue
+
+            if released_download_jobs:
+                logger.info(f"Resuming {released_download_jobs} expired download jobs")
+                self.download_job_queue.notify()
+
+    async def refresh_free_credits(self) -> None:
+        while True:
+            try:
+                refreshed_users = await self.db.user.refresh_all_free_credits(
+                    self.free_daily_credits
+                )
+            except Exception:
+                logger.exception("Failed to refresh free credits")
+            else:
+                if refreshed_users:
+                    logger.info(f"Refreshed free credits of {refreshed_users} users")
+
+            await asyncio.sleep(self.free_credits_refresh_interval)
+
+    async def flush_user_counters(self) -> None:
+        while True:
+            await asyncio.sleep(self.user_counters_flush_interval)
+            try:
+                await self.db.user.flush_counters()
+            except Exception:
+                logger.exception("Failed to flush user counters")
+
+    async def run_download_worker(self, worker_id: str) -> None:
+        while True:
+            try:
+                download_jobs = await self.db.download_job.claim_batch(worker_id)
+            except Exception:
+                logger.exception(f"Failed to claim download jobs@{worker_id}")
+                download_jobs = []
+
+            if not download_jobs:
+                await self.download_job_queue.wait(DOWNLOAD_JOB_POLL_INTERVAL)
+                continue
+
+            try:
+                await self.download_batch_handler(download_jobs)
+            except Exception:
+                logger.exception(f"{download_jobs[0].batch_id}@{worker_id}")
+
+    @staticmethod
+    def get_message_file_ids(message: Message) -> tuple[str | None, str | None]:
+        media = getattr(message, message.media.value, None) if message.media else None
+        if media is None:
+            return None, None
+
+        return media.file_id, media.file_unique_id
+
+    async def get_cache_messages(
+        self,
+        chat_id: int,
+        message_ids: list[int],
+    ) -> dict[int, Message]:
+        if not message_ids:
+            return {}
+
+        return {
+            cache_message.id: cache_message
+            for cache_message in await self.get_messages(chat_id, message_ids)
+            if not cache_message.empty
+        }
+
+    async def backfill_cache_file_ids(self) -> None:
+        logger.info("Backfilling cache file IDs")
+        try:
+            after = None
+            while songs := await self.db.song.get_many_without_file_id(
+                FILE_ID_BACKFILL_BATCH_SIZE,
+                after,
+            ):
+                after = (songs[-1].id, songs[-1].codec)
+                cache_messages = await self.rate_limiter.call(
+                    None,
+                    self.get_cache_messages,
+                    self.song_cache_chat_id,
+                    [
+                        message_id
+                        for song in songs
+                        for message_id in (
+                            song.message_id_song,
+                            song.message_id_synced_lyrics,
+                        )
+                        if message_id
+                    ],
+                )
+
+                song_file_ids = []
+                # Rows whose cache message is gone can never be backfilled and
+                # would be downloaded again anyway, so they are dropped instead
+                # of being rescanned on every start
+                broken_songs = []
+                for song in songs:
+                    song_cache_message = cache_messages.get(song.message_id_song)
+                    if song_cache_message is None or song.id not in (
+                        song_cache_message.caption or ""
+                    ):
+                        broken_songs.append(
+                            (song.id, song.codec, song.message_id_song)
+                        )
+                        continue
+
+                    file_id_song, file_unique_id_song = self.get_message_file_ids(
+                        song_cache_message
+                    )
+                    if file_id_song is None:
+                        broken_songs.append(
+                            (song.id, song.codec, song.message_id_song)
+                        )
+                        continue
+
+                    synced_lyrics_cache_message = cache_messages.get(
+                        song.message_id_synced_lyrics
+                    )
+                    if synced_lyrics_cache_message is not None:
+                        file_id_synced_lyrics, file_unique_id_synced_lyrics = (
+                            self.get_message_file_ids(synced_lyrics_cache_message)
+                        )
+                    else:
+                        file_id_synced_lyrics, file_unique_id_synced_lyrics = (
+                            None,
+                            None,
+                        )
+
+                    song_file_ids.append(
+                        {
+                            "song_id": song.id,
+                            "song_codec": song.codec,
+                            "read_message_id_song": song.message_id_song,
+                            "file_id_song": file_id_song,
+                            "file_unique_id_song": file_unique_id_song,
+                            "file_id_synced_lyrics": file_id_synced_lyrics,
+                            "file_unique_id_synced_lyrics": file_unique_id_synced_lyrics,
+                        }
+                    )
+
+                if song_file_ids:
+                    await self.db.song.update_file_ids(song_file_ids)
+                if broken_songs:
+                    await self.db.song.delete_many(broken_songs)
+
+            after = None
+            while music_videos := await self.db.music_video.get_many_without_file_id(
+                FILE_ID_BACKFILL_BATCH_SIZE,
+                after,
+            ):
+                after = (music_videos[-1].id, music_videos[-1].fourk)
+                cache_messages = await self.rate_limiter.call(
+                    None,
+                    self.get_cache_messages,
+                    self.music_video_cache_chat_id,
+                    [music_video.message_id for music_video in music_videos],
+                )
+
+                music_video_file_ids = []
+                broken_music_videos = []
+                for music_video in music_videos:
+                    music_video_cache_message = cache_messages.get(
+                        music_video.message_id
+                    )
+                    if music_video_cache_message is None or music_video.id not in (
+                        music_video_cache_message.caption or ""
+                    ):
+                        broken_music_videos.append(
+                            (music_video.id, music_video.fourk, music_video.message_id)
+                        )
+                        continue
+
+                    file_id, file_unique_id = self.get_message_file_ids(
+                        music_video_cache_message
+                    )
+                    if file_id is None:
+                        broken_music_videos.append(
+                            (music_video.id, music_video.fourk, music_video.message_id)
+                        )
+                        continue
+
+                    music_video_file_ids.append(
+                        {
+                            "music_video_id": music_video.id,
+                            "music_video_fourk": music_video.fourk,
+                            "read_message_id": music_video.message_id,
+                            "file_id": file_id,
+                            "file_unique_id": file_unique_id,
+                        }
+                    )
+
+                if music_video_file_ids:
+                    await self.db.music_video.update_file_ids(music_video_file_ids)
+                if broken_music_videos:
+                    await self.db.music_video.delete_many(broken_music_videos)
+        except Exception:
+            logger.exception("Failed to backfill cache file IDs")
+            return
+
+        logger.info("Cache file IDs backfilled")
+
     def get_lp(self, message: Message) -> Callable[..., str]:
         return lambda *path: self.lp.get(
             (message.from_user.language_code or "en").split("-")[0], *path
         )
 
-    async def ensure_user_exists(self, message: Message) -> None:
-        await self.db.user.add_if_not_exists(message.from_user.id)
+    async def load_user(
+        self,
+        message: Message,
+        create: bool = True,
+    ) -> User | None:
+        return await self.db.user.load(
+            message.from_user.id,
+            self.free_daily_credits,
+            create,
+        )
 
     def is_admin(self, message: Message) -> bool:
         return message.from_user.id == self.admin_user_id
 
-    async def add_free_daily_credits(self, message: Message) -> None:
-        user = await self.db.user.get(message.from_user.id)
-        if user is None:
-            return
-
-        now = datetime.datetime.now()
-        if (
-            user.last_free_credits_claim is None
-            or (now - user.last_free_credits_claim).total_seconds() >= 86400
-        ):
-            await self.db.user.set_credits(
-                user_id=user.id,
-                credits=self.free_daily_credits,
-            )
-            await self.db.user.update_last_free_credits_claim(
-                user_id=user.id,
-                claim_time=now,
-            )
-
     async def is_under_maintenance(self, message: Message) -> bool:
         lp = self.get_lp(message)
 
@@ -45,7 +45,7 @@ async def validate_activation_code(
     filters.text & (filters.private | filters.group) & filters.command("activate")
 )
 async def message(bot: PinkMusicBot, message: Message):
-    await bot.ensure_user_exists(message)
+    user = await bot.load_user(message)
     lp = bot.get_lp(message)
 
     if not message.command[1:]:
@@ -62,7 +62,6 @@ async def message(bot: PinkMusicBot, message: Message):
         await message.reply(lp("activate_invalid_code"))
         return
 
-    user = await bot.db.user.get(message.from_user.id)
     membership_due_date = await bot.db.user.add_membership_days(
         user.id,
         activation_result.days,
@@ -10,7 +10,7 @@ from ..bot import PinkMusicBot
     filters.text & (filters.private | filters.group) & filters.command("botstatus")
 )
 async def message(bot: PinkMusicBot, message: Message):
-    await bot.ensure_user_exists(message)
+    await bot.load_user(message)
     if not bot.is_admin(message):
         return
     lp = bot.get_lp(message)
@@ -29,6 +29,10 @@ async def message(bot: PinkMusicBot, message: Message):
             total_songs=total_songs,
             total_music_videos=total_music_videos,
             current_downloads=current_downloads,
+            coalesced_downloads=bot.single_flight.coalesced,
+            cover_cache_hit_rate=f"{bot.cover_cache.hit_rate:.1%}",
+            metadata_cache_hit_rate=f"{bot.metadata_cache.hit_rate:.1%}",
+            user_cache_hit_rate=f"{bot.db.user.cache.hit_rate:.1%}",
             bot_lock=lp("enabled") if bot_lock else lp("disabled"),
         )
     )
@@ -8,10 +8,9 @@ from ..bot import PinkMusicBot
     filters.text & (filters.private | filters.group) & filters.command("clearme")
 )
 async def message(bot: PinkMusicBot, message: Message):
-    await bot.add_free_daily_credits(message)
     lp = bot.get_lp(message)
 
-    user = await bot.db.user.get(message.from_user.id)
+    user = await bot.load_user(message, create=False)
     if user is None:
         await message.reply(lp("clearme_fail"))
         return
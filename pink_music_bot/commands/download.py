@@ -1,8 +1,15 @@
 import asyncio
 import logging
 import os
+import re
+import uuid
+from collections import deque
+from contextlib import aclosing, nullcontext
+from dataclasses import dataclass, field
 from io import BytesIO
+from typing import AsyncIterator, Callable, Iterable
 
+import httpx
 from gamdl.downloader import (
     AppleMusicBaseDownloader,
     AppleMusicDownloader,
@@ -20,48 +27,107 @@ from gamdl.downloader.constants import (
     VALID_URL_PATTERN,
 )
 from gamdl.interface import (
+    AppleMusicInterface,
     AppleMusicMusicVideoInterface,
     AppleMusicSongInterface,
     MusicVideoResolution,
     SongCodec,
 )
 from pyrogram import filters
+from pyrogram.errors import BadRequest
 from pyrogram.types import Message
 
 from ..bot import PinkMusicBot
-from ..database import MusicVideo, Song
+from ..constants import BotMode
+from ..database import DownloadJob, MusicVideo, Song, User
+from ..upload_client import reuse_saved_files
 
 logger = logging.getLogger(__name__)
 
+MAX_GET_MESSAGES = 200
+MAX_FORWARD_MESSAGES = 100
+DOWNLOAD_QUEUE_FIRST_CHUNK_SIZE = 5
+DOWNLOAD_QUEUE_MAX_CHUNK_SIZE = MAX_GET_MESSAGES
+DOWNLOAD_QUEUE_CONCURRENCY = 10
+# Bitrates in bits per second used to estimate the temp size of a download
+SONG_ESTIMATED_BITRATES = {
+    SongCodec.ALAC: 4_608_000,
+    SongCodec.ATMOS: 768_000,
+}
+SONG_DEFAULT_ESTIMATED_BITRATE = 256_000
+MUSIC_VIDEO_ESTIMATED_BITRATE = 10_000_000
+MUSIC_VIDEO_FOURK_ESTIMATED_BITRATE = 25_000_000
+MUSIC_VIDEO_AUDIO_ESTIMATED_BITRATE = 256_000
+# The encrypted download, the decrypted file and the remuxed file can all
+# exist in the temp path at once
+TEMP_SIZE_FACTOR = 3
+MAX_UPLOAD_FILE_SIZE = 2000 * 1024 * 1024
+STREAM_INF_ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+async def enqueue_upload(
+    bot: PinkMusicBot,
+    high_priority: bool,
+    user_id: int,
+    send_method: str,
+    **kwargs,
+) -> Message:
+    priority = 0 if high_priority else 1
+    async with bot.upload_priority_semaphore.acquire(priority, user_id):
+        async with bot.upload_pool.lease() as client:
+            # A send retried after a FloodWait only repeats the send request,
+            # the file is uploaded once
+            with reuse_saved_files():
+                message = await bot.rate_limiter.call(
+                    (
+                        kwargs["chat_id"]
+                        if client is bot
+                        else (client.name, kwargs["chat_id"])
+                    ),
+                    getattr(client, send_method),
+                    **kwargs,
+                )
+
+    if client is bot:
+        return message
+
+    # File ids are only valid for the bot that received them, so the message
+    # a helper bot uploaded is fetched again by the main bot
+    return await bot.rate_limiter.call(
+        None,
+        bot.get_messages,
+        kwargs["chat_id"],
+        message.id,
+    )
+
 
 async def enqueue_upload_audio(
     bot: PinkMusicBot,
     high_priority: bool,
+    user_id: int,
     **kwargs,
 ) -> Message:
-    priority = 0 if high_priority else 1
-    async with bot.upload_priority_semaphore.acquire(priority):
-        return await bot.send_audio(**kwargs)
+    return await enqueue_upload(bot, high_priority, user_id, "send_audio", **kwargs)
 
 
 async def enqueue_upload_video(
     bot: PinkMusicBot,
     high_priority: bool,
+    user_id: int,
     **kwargs,
 ) -> Message:
-    priority = 0 if high_priority else 1
-    async with bot.upload_priority_semaphore.acquire(priority):
-        return await bot.send_video(**kwargs)
+    return await enqueue_upload(bot, high_priority, user_id, "send_video", **kwargs)
 
 
 async def enqueue_upload_document(
     bot: PinkMusicBot,
     high_priority: bool,
+    user_id: int,
     **kwargs,
 ) -> Message:
-    priority = 0 if high_priority else 1
-    async with bot.upload_priority_semaphore.acquire(priority):
-        return await bot.send_document(**kwargs)
+    return await enqueue_upload(
+        bot, high_priority, user_id, "send_document", **kwargs
+    )
 
 
 async def enqueue_download(
@@ -70,24 +136,27 @@ async def enqueue_download(
     download_item: DownloadItem,
     use_wrapper: bool,
     high_priority: bool,
+    user_id: int,
 ) -> DownloadItem:
     priority = 0 if high_priority else 1
 
     if use_wrapper:
         downloader.base_downloader.use_wrapper = True
 
-        async with bot.wrapper_locker:
-            async with bot.download_priority_semaphore.acquire(priority):
+        # The decrypt slot is only leased once the download may run, so
+        # downloads waiting for the semaphore don't hold it
+        async with bot.download_priority_semaphore.acquire(priority, user_id):
+            async with bot.wrapper_pool.lease() as wrapper_decrypt_ip:
+                downloader.base_downloader.wrapper_decrypt_ip = wrapper_decrypt_ip
                 result = await asyncio.wait_for(
                     downloader.download(download_item),
                     timeout=bot.download_timeout,
                 )
-            await asyncio.sleep(5)
 
     else:
         downloader.base_downloader.use_wrapper = False
 
-        async with bot.download_priority_semaphore.acquire(priority):
+        async with bot.download_priority_semaphore.acquire(priority, user_id):
             result = await asyncio.wait_for(
                 downloader.download(download_item),
                 timeout=bot.download_timeout,
@@ -96,50 +165,998 @@ async def enqueue_download(
     return result
 
 
-@PinkMusicBot.on_message(
-    filters.text
-    & (filters.private | filters.group)
-    & (filters.command("download") | filters.regex(r"^(?!/)"))
-)
-async def message(bot: PinkMusicBot, message: Message):
-    lp = bot.get_lp(message)
-    await bot.ensure_user_exists(message)
-    await bot.add_free_daily_credits(message)
+async def resolve_cache_entries(
+    bot: PinkMusicBot,
+    user: User,
+    url_download_queue: list[DownloadItem],
+) -> None:
+    song_ids = []
+    music_video_ids = {True: [], False: []}
+    for download_item in url_download_queue:
+        if isinstance(download_item.flat_filter_result, str):
+            continue
+
+        if download_item.media_metadata["type"] in SONG_MEDIA_TYPE:
+            song_ids.append(download_item.media_metadata["id"])
+        else:
+            music_video_ids[get_music_video_fourk(user, download_item)].append(
+                download_item.media_metadata["id"]
+            )
+
+    songs = (
+        await bot.db.song.get_many(song_ids, user.song_codec) if song_ids else {}
+    )
+    music_videos = {
+        fourk: await bot.db.music_video.get_many(ids, fourk) if ids else {}
+        for fourk, ids in music_video_ids.items()
+    }
+
+    for download_item in url_download_queue:
+        if isinstance(download_item.flat_filter_result, str):
+            continue
+
+        media_id = download_item.media_metadata["id"]
+        if download_item.media_metadata["type"] in SONG_MEDIA_TYPE:
+            download_item.flat_filter_result = songs.get(media_id)
+        else:
+            download_item.flat_filter_result = music_videos[
+                get_music_video_fourk(user, download_item)
+            ].get(media_id)
+
+
+def get_music_video_fourk(user: User, download_item: DownloadItem) -> bool:
+    return bool(
+        user.fourk_download and download_item.media_metadata["attributes"]["has4K"]
+    )
+
+
+def get_music_video_variant_bitrate(m3u8_master: str, resolution: int) -> int | None:
+    # Mirrors the downloader's variant selection: the closest resolution not
+    # above the requested one, preferring the highest bitrate
+    variants = []
+    for line in m3u8_master.splitlines():
+        if not line.startswith("#EXT-X-STREAM-INF:"):
+            continue
+
+        attributes = dict(STREAM_INF_ATTRIBUTE_PATTERN.findall(line.partition(":")[2]))
+        if "RESOLUTION" not in attributes or "BANDWIDTH" not in attributes:
+            continue
+
+        height = int(attributes["RESOLUTION"].split("x")[-1])
+        peak_bitrate = int(attributes["BANDWIDTH"])
+        variants.append(
+            (
+                height > resolution,
+                abs(height - resolution),
+                -height,
+                -peak_bitrate,
+                int(attributes.get("AVERAGE-BANDWIDTH", peak_bitrate)),
+            )
+        )
+
+    if not variants:
+        return None
+
+    return min(variants)[-1]
+
+
+def estimate_temp_size(
+    user: User,
+    download_item: DownloadItem,
+    estimated_size: int | None = None,
+) -> int:
+    if estimated_size is not None:
+        return estimated_size * TEMP_SIZE_FACTOR
+
+    if download_item.media_metadata["type"] in SONG_MEDIA_TYPE:
+        bitrate = SONG_ESTIMATED_BITRATES.get(
+            user.song_codec,
+            SONG_DEFAULT_ESTIMATED_BITRATE,
+        )
+    elif get_music_video_fourk(user, download_item):
+        bitrate = MUSIC_VIDEO_FOURK_ESTIMATED_BITRATE
+    else:
+        bitrate = MUSIC_VIDEO_ESTIMATED_BITRATE
+
+    duration = download_item.media_metadata["attributes"]["durationInMillis"] / 1000
+    return int(duration * bitrate / 8 * TEMP_SIZE_FACTOR)
+
+
+async def get_cache_messages(
+    bot: PinkMusicBot,
+    url_download_queue: list[DownloadItem],
+) -> dict[tuple[int, int], Message]:
+    message_ids = {
+        bot.song_cache_chat_id: set(),
+        bot.music_video_cache_chat_id: set(),
+    }
+    for download_item in url_download_queue:
+        database_entry = download_item.flat_filter_result
+        if isinstance(database_entry, Song):
+            message_ids[bot.song_cache_chat_id].add(database_entry.message_id_song)
+            if database_entry.message_id_synced_lyrics:
+                message_ids[bot.song_cache_chat_id].add(
+                    database_entry.message_id_synced_lyrics
+                )
+        elif isinstance(database_entry, MusicVideo) and database_entry.message_id:
+            message_ids[bot.music_video_cache_chat_id].add(database_entry.message_id)
+
+    cache_messages = {}
+    for chat_id, chat_message_ids in message_ids.items():
+        chat_message_ids = sorted(chat_message_ids)
+        for i in range(0, len(chat_message_ids), MAX_GET_MESSAGES):
+            chunk_cache_messages = await bot.rate_limiter.call(
+                None,
+                bot.get_cache_messages,
+                chat_id,
+                chat_message_ids[i : i + MAX_GET_MESSAGES],
+            )
+            cache_messages.update(
+                ((chat_id, message_id), cache_message)
+                for message_id, cache_message in chunk_cache_messages.items()
+            )
+    return cache_messages
+
+
+async def forward_cache_messages(
+    bot: PinkMusicBot,
+    chat_id: int,
+    cache_chat_id: int,
+    message_ids: list[int],
+) -> None:
+    for i in range(0, len(message_ids), MAX_FORWARD_MESSAGES):
+        await bot.rate_limiter.call(
+            chat_id,
+            bot.forward_messages,
+            chat_id,
+            cache_chat_id,
+            message_ids[i : i + MAX_FORWARD_MESSAGES],
+            drop_author=True,
+            remove_caption=True,
+        )
+
+
+async def send_cache_files(
+    bot: PinkMusicBot,
+    chat_id: int,
+    cache_chat_id: int,
+    file_ids: list[str],
+    message_ids: list[int],
+) -> None:
+    for file_id, message_id in zip(file_ids, message_ids):
+        try:
+            await bot.rate_limiter.call(
+                chat_id,
+                bot.send_cached_media,
+                chat_id,
+                file_id,
+            )
+        except BadRequest:
+            logger.warning(f"File ID rejected, forwarding {cache_chat_id}/{message_id}")
+            await forward_cache_messages(bot, chat_id, cache_chat_id, [message_id])
+
+
+@dataclass
+class DownloadContext:
+    bot: PinkMusicBot
+    message: Message
+    lp: Callable[..., str]
+    user: User
+    interface: AppleMusicInterface
+    base_downloader: AppleMusicBaseDownloader
+    song_downloader: AppleMusicSongDownloader
+    music_video_downloader: AppleMusicMusicVideoDownloader
+    downloader: AppleMusicDownloader
+    # Jobs holding a credit taken from the database that was not spent yet
+    reserved_download_job_ids: set[int] = field(default_factory=set)
+
+
+@dataclass
+class PipelineItem:
+    download_item: DownloadItem | None = None
+    media_title: str | None = None
+    reply: str | None = None
+    cache_chat_id: int | None = None
+    cache_message_ids: list[int] = field(default_factory=list)
+    cache_file_ids: list[str] = field(default_factory=list)
+    songs_downloaded: int = 0
+    music_videos_downloaded: int = 0
+    download_job_ids: list[int] = field(default_factory=list)
+    disk_reservation: int = 0
+    flight_key: tuple[str, SongCodec | bool] | None = None
+    downloaded: bool = False
+    failed: bool = False
+    abort: bool = False
+
+    def can_merge(self, other: "PipelineItem") -> bool:
+        return (
+            not self.cache_file_ids
+            and not other.cache_file_ids
+            and self.cache_chat_id == other.cache_chat_id
+            and len(self.cache_message_ids) + len(other.cache_message_ids)
+            <= MAX_FORWARD_MESSAGES
+        )
+
+    def merge(self, other: "PipelineItem") -> None:
+        self.cache_message_ids.extend(other.cache_message_ids)
+        self.songs_downloaded += other.songs_downloaded
+        self.music_videos_downloaded += other.music_videos_downloaded
+        self.download_job_ids.extend(other.download_job_ids)
+
+
+def release_pipeline_item(
+    context: DownloadContext,
+    pipeline_item: PipelineItem,
+) -> None:
+    context.base_downloader.cleanup_temp(pipeline_item.download_item.random_uuid)
+    if pipeline_item.disk_reservation:
+        context.bot.disk_admission.release(pipeline_item.disk_reservation)
+        pipeline_item.disk_reservation = 0
+    if pipeline_item.flight_key is not None:
+        context.bot.single_flight.finish(pipeline_item.flight_key)
+        pipeline_item.flight_key = None
+
+
+def release_pipeline_items(
+    context: DownloadContext,
+    pipeline_items: list[PipelineItem | None],
+) -> None:
+    # Releasing is idempotent, so items that were already uploaded or never
+    # downloaded can be passed as well
+    for pipeline_item in pipeline_items:
+        if pipeline_item is not None and pipeline_item.download_item is not None:
+            release_pipeline_item(context, pipeline_item)
+
+
+def fail_pipeline_item(context: DownloadContext, pipeline_item: PipelineItem) -> None:
+    logger.exception(
+        f"{pipeline_item.download_item.media_metadata['id']}@{context.message.from_user.id}"
+    )
+    pipeline_item.failed = True
+    pipeline_item.reply = context.lp("download_fail").format(
+        title=pipeline_item.media_title
+    )
+    pipeline_item.songs_downloaded = 0
+    pipeline_item.music_videos_downloaded = 0
+
+
+def has_cache_file_ids(user: User, database_entry: Song | MusicVideo) -> bool:
+    if isinstance(database_entry, Song):
+        return bool(
+            database_entry.file_id_song
+            and (
+                not database_entry.message_id_synced_lyrics
+                or not user.synced_lyrics_file_upload
+                or database_entry.file_id_synced_lyrics
+            )
+        )
+
+    return bool(database_entry.file_id)
+
+
+def apply_cache_entry(
+    context: DownloadContext,
+    pipeline_item: PipelineItem,
+    cache_messages: dict[tuple[int, int], Message],
+    use_file_ids: bool,
+) -> bool:
+    bot = context.bot
+    user = context.user
+    download_item = pipeline_item.download_item
+
+    if isinstance(download_item.flat_filter_result, Song):
+        database_entry = download_item.flat_filter_result
+        song_cache_message = cache_messages.get(
+            (bot.song_cache_chat_id, database_entry.message_id_song)
+        )
+
+        if database_entry.message_id_synced_lyrics:
+            synced_lyrics_cache_message = cache_messages.get(
+                (bot.song_cache_chat_id, database_entry.message_id_synced_lyrics)
+            )
+        else:
+            synced_lyrics_cache_message = None
+
+        # Song cache is valid if:
+        cache_is_valid = (
+            # - The song is sent by file ID, which Telegram validates itself,
+            #   or the song message exists
+            (
+                use_file_ids
+                or (song_cache_message and not song_cache_message.empty)
+            )
+            # - The lyrics message exists if lyrics are available
+            and not (
+                not database_entry.message_id_synced_lyrics
+                and (download_item.lyrics and download_item.lyrics.synced)
+            )
+            # - The lyrics message exists if lyrics are stored
+            and (
+                use_file_ids
+                or not database_entry.message_id_synced_lyrics
+                or (
+                    synced_lyrics_cache_message
+                    and not synced_lyrics_cache_message.empty
+                )
+            )
+            # - The song message caption contains the ID
+            and (
+                use_file_ids
+                or download_item.media_metadata["id"]
+                in (song_cache_message.caption or "")
+            )
+        )
+
+        if cache_is_valid:
+            pipeline_item.cache_chat_id = bot.song_cache_chat_id
+            pipeline_item.cache_message_ids.append(database_entry.message_id_song)
+            if use_file_ids:
+                pipeline_item.cache_file_ids.append(database_entry.file_id_song)
+            if (
+                database_entry.message_id_synced_lyrics
+                and user.synced_lyrics_file_upload
+            ):
+                pipeline_item.cache_message_ids.append(
+                    database_entry.message_id_synced_lyrics
+                )
+                if use_file_ids:
+                    pipeline_item.cache_file_ids.append(
+                        database_entry.file_id_synced_lyrics
+                    )
+            pipeline_item.songs_downloaded = 1
+            return True
+
+    if isinstance(download_item.flat_filter_result, MusicVideo):
+        database_entry = download_item.flat_filter_result
+
+        if database_entry.too_large:
+            pipeline_item.reply = context.lp("download_too_large").format(
+                title=pipeline_item.media_title
+            )
+            return True
+
+        music_video_cache_message = cache_messages.get(
+            (bot.music_video_cache_chat_id, database_entry.message_id)
+        )
+
+        # Music video cache is valid if:
+        cache_is_valid = use_file_ids or (
+            # - The music video message exists
+            music_video_cache_message
+            and not music_video_cache_message.empty
+            # - The music video message caption contains the ID
+            and download_item.media_metadata["id"]
+            in (music_video_cache_message.caption or "")
+        )
+
+        if cache_is_valid:
+            pipeline_item.cache_chat_id = bot.music_video_cache_chat_id
+            pipeline_item.cache_message_ids.append(database_entry.message_id)
+            if use_file_ids:
+                pipeline_item.cache_file_ids.append(database_entry.file_id)
+            pipeline_item.music_videos_downloaded = 1
+            return True
+
+    return False
+
+
+async def join_single_flight(
+    context: DownloadContext,
+    pipeline_item: PipelineItem,
+) -> bool:
+    bot = context.bot
+    user = context.user
+    download_item = pipeline_item.download_item
+    media_id = download_item.media_metadata["id"]
+
+    if download_item.media_metadata["type"] in SONG_MEDIA_TYPE:
+        flight_key = (media_id, user.song_codec)
+    else:
+        flight_key = (media_id, get_music_video_fourk(user, download_item))
+
+    # If another request is already downloading this item, wait for it to be
+    # uploaded and serve it from the cache instead of downloading it again
+    while (flight := bot.single_flight.join(flight_key)) is not None:
+        await asyncio.shield(flight)
+
+        if download_item.media_metadata["type"] in SONG_MEDIA_TYPE:
+            database_entry = await bot.db.song.get(media_id, user.song_codec)
+        else:
+            database_entry = await bot.db.music_video.get(media_id, flight_key[1])
+        if database_entry is None:
+            continue
+
+        download_item.flat_filter_result = database_entry
+        use_file_ids = has_cache_file_ids(user, database_entry)
+        cache_messages = (
+            {} if use_file_ids else await get_cache_messages(bot, [download_item])
+        )
+        if apply_cache_entry(context, pipeline_item, cache_messages, use_file_ids):
+            return True
+
+    pipeline_item.flight_key = flight_key
+    return False
+
+
+async def estimate_music_video_size(
+    context: DownloadContext,
+    download_item: DownloadItem,
+) -> int | None:
+    webplayback = await context.interface.apple_music_api.get_webplayback(
+        download_item.media_metadata["id"]
+    )
+    async with httpx.AsyncClient() as http_client:
+        response = await http_client.get(
+            webplayback["songList"][0]["hls-playlist-url"]
+        )
+        response.raise_for_status()
+
+    video_bitrate = get_music_video_variant_bitrate(
+        response.text,
+        2160 if context.user.fourk_download else 1080,
+    )
+    if video_bitrate is None:
+        return None
+
+    duration = download_item.media_metadata["attributes"]["durationInMillis"] / 1000
+    return int(duration * (video_bitrate + MUSIC_VIDEO_AUDIO_ESTIMATED_BITRATE) / 8)
+
+
+async def preflight_music_video(
+    context: DownloadContext,
+    pipeline_item: PipelineItem,
+) -> int | None:
+    bot = context.bot
+    download_item = pipeline_item.download_item
+
+    try:
+        estimated_size = await estimate_music_video_size(context, download_item)
+    except Exception:
+        logger.warning(
+            f"Failed to estimate size of {download_item.media_metadata['id']}",
+            exc_info=True,
+        )
+        return None
+
+    # Only items that exceed the limit by more than the margin are skipped,
+    # borderline ones are still downloaded and checked after remuxing
+    if estimated_size is not None and estimated_size > MAX_UPLOAD_FILE_SIZE * (
+        1 + bot.music_video_size_margin
+    ):
+        pipeline_item.reply = context.lp("download_too_large").format(
+            title=pipeline_item.media_title
+        )
+        await bot.db.music_video.add_if_not_exists(
+            download_item.media_metadata["id"],
+            get_music_video_fourk(context.user, download_item),
+            None,
+            True,
+        )
+
+    return estimated_size
+
+
+async def download_pipeline_item(
+    context: DownloadContext,
+    pipeline_item: PipelineItem,
+) -> None:
+    user = context.user
+    download_item = pipeline_item.download_item
+
+    try:
+        if await join_single_flight(context, pipeline_item):
+            return
+
+        if download_item.media_metadata["type"] in SONG_MEDIA_TYPE:
+            estimated_size = None
+        else:
+            estimated_size = await preflight_music_video(context, pipeline_item)
+            if pipeline_item.reply:
+                return
+
+        # Waiting for disk space happens before taking a download slot, and
+        # the reservation is kept until the temp files are cleaned up
+        disk_reservation = estimate_temp_size(user, download_item, estimated_size)
+        await context.bot.disk_admission.acquire(disk_reservation)
+        pipeline_item.disk_reservation = disk_reservation
+
+        pipeline_item.download_item = await enqueue_download(
+            context.bot,
+            context.downloader,
+            download_item,
+            user.song_codec != SongCodec.AAC_LEGACY
+            and download_item.media_metadata["type"] in SONG_MEDIA_TYPE,
+            user.active_membership,
+            user.id,
+        )
+        pipeline_item.downloaded = True
+    except FormatNotAvailable:
+        pipeline_item.reply = context.lp("download_format_unavailable").format(
+            title=pipeline_item.media_title
+        )
+    except NotStreamable:
+        pipeline_item.reply = context.lp("download_unstremeable").format(
+            title=pipeline_item.media_title
+        )
+    except asyncio.TimeoutError:
+        pipeline_item.reply = context.lp("download_timeout")
+        pipeline_item.abort = True
+    except Exception:
+        fail_pipeline_item(context, pipeline_item)
+    finally:
+        if not pipeline_item.downloaded:
+            release_pipeline_item(context, pipeline_item)
+
+
+async def upload_pipeline_item(
+    context: DownloadContext,
+    pipeline_item: PipelineItem,
+) -> None:
+    bot = context.bot
+    user = context.user
+    interface = context.interface
+    base_downloader = context.base_downloader
+    download_item = pipeline_item.download_item
+
+    try:
+        if download_item.cover_url_template:
+            cover_url_telegram = base_downloader.format_cover_url(
+                download_item.cover_url_template,
+                300,
+                "jpg",
+            )
+            cover_data = await bot.cover_cache.get(
+                download_item.cover_url_template,
+                300,
+                lambda: base_downloader.get_cover_bytes(cover_url_telegram),
+            )
+            cover_bytes_telegram = BytesIO(cover_data) if cover_data else None
+        else:
+            cover_bytes_telegram = None
+
+        if download_item.media_metadata["type"] in SONG_MEDIA_TYPE:
+            caption_song = " ".join(
+                [
+                    f"<code>{download_item.media_metadata['id']}</code>",
+                    f"<code>{interface.apple_music_api.storefront.upper()}</code>",
+                    f"<code>{user.song_codec.value}</code>",
+                    "<code>song</code>",
+                ]
+            )
+            if download_item.lyrics and download_item.lyrics.synced:
+                caption_lyrics = " ".join(
+                    [
+                        f"<code>{download_item.media_metadata['id']}</code>",
+                        f"<code>{interface.apple_music_api.storefront.upper()}</code>",
+                        f"<code>{user.song_codec.value}</code>",
+                        "<code>lyrics</code>",
+                    ]
+                )
+            else:
+                caption_lyrics = None
+
+            message_song = await enqueue_upload_audio(
+                bot,
+                user.active_membership,
+                user.id,
+                chat_id=bot.song_cache_chat_id,
+                audio=download_item.staged_path,
+                thumb=cover_bytes_telegram,
+                caption=caption_song,
+                duration=download_item.media_metadata["attributes"]["durationInMillis"]
+                // 1000,
+                performer=download_item.media_tags.artist,
+                title=download_item.media_tags.title,
+                file_name=os.path.basename(download_item.final_path),
+            )
+            if caption_lyrics:
+                message_lyrics = await enqueue_upload_document(
+                    bot,
+                    user.active_membership,
+                    user.id,
+                    chat_id=bot.song_cache_chat_id,
+                    document=BytesIO(download_item.lyrics.synced.encode("utf-8")),
+                    caption=caption_lyrics,
+                    file_name=os.path.basename(
+                        context.song_downloader.get_lyrics_synced_path(
+                            download_item.final_path
+                        )
+                    ),
+                )
+            else:
+                message_lyrics = None
+
+            file_id_song, file_unique_id_song = bot.get_message_file_ids(message_song)
+            if message_lyrics:
+                file_id_synced_lyrics, file_unique_id_synced_lyrics = (
+                    bot.get_message_file_ids(message_lyrics)
+                )
+            else:
+                file_id_synced_lyrics, file_unique_id_synced_lyrics = None, None
+
+            await bot.db.song.add_if_not_exists(
+                download_item.media_metadata["id"],
+                user.song_codec,
+                message_song.id,
+                message_lyrics.id if message_lyrics else None,
+                file_id_song,
+                file_unique_id_song,
+                file_id_synced_lyrics,
+                file_unique_id_synced_lyrics,
+            )
+
+            pipeline_item.cache_chat_id = bot.song_cache_chat_id
+            pipeline_item.cache_message_ids.append(message_song.id)
+            if message_lyrics and user.synced_lyrics_file_upload:
+                pipeline_item.cache_message_ids.append(message_lyrics.id)
+            pipeline_item.songs_downloaded = 1
+
+        else:
+            file_size = os.path.getsize(download_item.staged_path)
+            fourk = get_music_video_fourk(user, download_item)
+
+            if file_size > MAX_UPLOAD_FILE_SIZE:
+                pipeline_item.reply = context.lp("download_too_large").format(
+                    title=pipeline_item.media_title
+                )
+                await bot.db.music_video.add_if_not_exists(
+                    download_item.media_metadata["id"],
+                    fourk,
+                    None,
+                    True,
+                )
+                return
+
+            caption_mv = " ".join(
+                [
+                    f"<code>{download_item.media_metadata['id']}</code>",
+                    f"<code>{interface.apple_music_api.storefront.upper()}</code>",
+                    f"<code>{'uhd' if fourk else 'hd'}</code>",
+                    "<code>music_video</code>",
+                ]
+            )
 
-    if bot.user_locker.is_user_locked(message.from_user.id):
-        await message.reply(lp("download_pending"))
+            message_music_video = await enqueue_upload_video(
+                bot,
+                user.active_membership,
+                user.id,
+                chat_id=bot.music_video_cache_chat_id,
+                video=download_item.staged_path,
+                thumb=cover_bytes_telegram,
+                caption=caption_mv,
+                duration=download_item.media_metadata["attributes"]["durationInMillis"]
+                // 1000,
+                file_name=os.path.basename(download_item.final_path),
+                supports_streaming=True,
+            )
+
+            file_id, file_unique_id = bot.get_message_file_ids(message_music_video)
+            await bot.db.music_video.add_if_not_exists(
+                download_item.media_metadata["id"],
+                fourk,
+                message_music_video.id,
+                file_id=file_id,
+                file_unique_id=file_unique_id,
+            )
+
+            pipeline_item.cache_chat_id = bot.music_video_cache_chat_id
+            pipeline_item.cache_message_ids.append(message_music_video.id)
+            pipeline_item.music_videos_downloaded = 1
+    except Exception:
+        fail_pipeline_item(context, pipeline_item)
+    finally:
+        release_pipeline_item(context, pipeline_item)
+
+
+async def reserve_download_credits(
+    context: DownloadContext,
+    download_job_ids: list[int],
+) -> None:
+    # Credits for a whole chunk are taken with one conditional UPDATE, users
+    # that cannot pay for all of it get what they have left. Jobs resumed
+    # from a previous run may still hold theirs.
+    user = context.user
+    download_job_ids = [
+        download_job_id
+        for download_job_id in download_job_ids
+        if download_job_id not in context.reserved_download_job_ids
+    ]
+    while download_job_ids:
+        remaining_credits = await context.bot.db.user.reserve_credits(
+            user.id,
+            download_job_ids,
+        )
+        if remaining_credits is not None:
+            user.credits = remaining_credits
+            context.reserved_download_job_ids.update(download_job_ids)
+            return
+
+        current_user = await context.bot.db.user.get(user.id)
+        download_job_ids = download_job_ids[
+            : max(current_user.credits, 0) if current_user else 0
+        ]
+
+
+async def refund_download_credits(
+    context: DownloadContext,
+    download_job_ids: Iterable[int],
+) -> None:
+    download_job_ids = [
+        download_job_id
+        for download_job_id in download_job_ids
+        if download_job_id in context.reserved_download_job_ids
+    ]
+    if not download_job_ids:
         return
 
-    async with bot.user_locker.acquire_user_lock(message.from_user.id):
-        await _message(bot, message, lp)
+    try:
+        credits = await context.bot.db.user.refund_credits(
+            context.user.id,
+            download_job_ids,
+            context.bot.free_daily_credits,
+        )
+    except Exception:
+        # The jobs keep their credits, which are refunded when the batch is
+        # deleted or resumed
+        logger.exception(f"refund_credits@{context.message.from_user.id}")
+        return
 
+    if credits is not None:
+        context.user.credits = credits
+    context.reserved_download_job_ids.difference_update(download_job_ids)
+
+
+async def download_stage(
+    context: DownloadContext,
+    download_queue: AsyncIterator[tuple[list[DownloadItem], list[int]]],
+    upload_queue: asyncio.Queue[PipelineItem | None],
+) -> None:
+    bot = context.bot
+    message = context.message
+    lp = context.lp
+    user = context.user
+    # Consecutive cache hits are merged into one item so they can be
+    # delivered with a single forward_messages call
+    cached_item = None
+
+    async def flush_cached_item() -> None:
+        nonlocal cached_item
+        if cached_item:
+            await upload_queue.put(cached_item)
+            cached_item = None
+
+    async def put(pipeline_item: PipelineItem | None) -> None:
+        try:
+            await flush_cached_item()
+            await upload_queue.put(pipeline_item)
+        except BaseException:
+            # The stages are cancelled when delivery fails, and items that
+            # never reached the queue would keep their single flight
+            release_pipeline_items(context, [cached_item, pipeline_item])
+            raise
+
+    try:
+        async for url_download_queue, download_job_ids in download_queue:
+            cache_entries = [
+                download_item.flat_filter_result
+                for download_item in url_download_queue
+                if isinstance(download_item.flat_filter_result, (Song, MusicVideo))
+            ]
+            # Sending by file ID costs one call per file but needs no
+            # validation, while batched delivery costs one get_messages call
+            # plus one forward per run of cache hits, so file IDs only pay off
+            # for a single entry. Chunks with several cache entries are always
+            # forwarded, even when every entry has its file IDs.
+            use_file_ids = len(cache_entries) == 1 and has_cache_file_ids(
+                user,
+                cache_entries[0],
+            )
+            cache_messages = (
+                {}
+                if use_file_ids
+                else await get_cache_messages(bot, url_download_queue)
+            )
 
-async def _message(bot: PinkMusicBot, message: Message, lp):
-    if await bot.is_under_maintenance(message):
+            if not user.active_membership:
+                await reserve_download_credits(
+                    context,
+                    [
+                        download_job_id
+                        for download_item, download_job_id in zip(
+                            url_download_queue,
+                            download_job_ids,
+                        )
+                        if not isinstance(download_item.flat_filter_result, str)
+                    ],
+                )
+
+            for download_item, download_job_id in zip(
+                url_download_queue,
+                download_job_ids,
+            ):
+                if await bot.is_under_maintenance(message):
+                    await put(PipelineItem(abort=True))
+                    return
+
+                if isinstance(download_item.flat_filter_result, str):
+                    await put(
+                        PipelineItem(
+                            reply=download_item.flat_filter_result,
+                            download_job_ids=[download_job_id],
+                        )
+                    )
+                    continue
+
+                if (
+                    not user.active_membership
+                    and download_job_id not in context.reserved_download_job_ids
+                ):
+                    await put(
+                        PipelineItem(abort=True, reply=lp("download_no_credits"))
+                    )
+                    return
+
+                pipeline_item = PipelineItem(
+                    download_item=download_item,
+                    media_title=download_item.media_metadata["attributes"]["name"],
+                    download_job_ids=[download_job_id],
+                )
+
+                if apply_cache_entry(
+                    context,
+                    pipeline_item,
+                    cache_messages,
+                    use_file_ids,
+                ):
+                    if not pipeline_item.cache_message_ids:
+                        await put(pipeline_item)
+                    elif cached_item and cached_item.can_merge(pipeline_item):
+                        cached_item.merge(pipeline_item)
+                    else:
+                        await flush_cached_item()
+                        cached_item = pipeline_item
+                    continue
+
+                # Cache hits before this item are delivered while it downloads
+                await flush_cached_item()
+                await download_pipeline_item(context, pipeline_item)
+                await put(pipeline_item)
+
+                if pipeline_item.abort:
+                    return
+    except Exception:
+        logger.exception(f"download_stage@{message.from_user.id}")
+        await put(PipelineItem(abort=True))
         return
 
-    user = await bot.db.user.get(message.from_user.id)
+    await put(None)
 
-    if user.credits <= 0 and not user.active_membership:
-        await message.reply(lp("download_no_credits"))
+
+async def upload_stage(
+    context: DownloadContext,
+    upload_queue: asyncio.Queue[PipelineItem | None],
+    delivery_queue: asyncio.Queue[PipelineItem | None],
+) -> None:
+    try:
+        while (pipeline_item := await upload_queue.get()) is not None:
+            if pipeline_item.downloaded:
+                await upload_pipeline_item(context, pipeline_item)
+
+            await delivery_queue.put(pipeline_item)
+
+            if pipeline_item.abort:
+                return
+    except Exception:
+        logger.exception(f"upload_stage@{context.message.from_user.id}")
+        await delivery_queue.put(PipelineItem(abort=True))
         return
 
-    if not user.active_membership and user.song_codec != SongCodec.AAC_LEGACY:
-        await message.reply(lp("download_songcodec_fallback"))
-        user.song_codec = SongCodec.AAC_LEGACY
-        await bot.db.user.update_song_codec(
-            user.id,
-            SongCodec.AAC_LEGACY,
+    await delivery_queue.put(None)
+
+
+async def delivery_stage(
+    context: DownloadContext,
+    delivery_queue: asyncio.Queue[PipelineItem | None],
+) -> tuple[bool, int]:
+    bot = context.bot
+    message = context.message
+    error_count = 0
+
+    while (pipeline_item := await delivery_queue.get()) is not None:
+        try:
+            if pipeline_item.cache_file_ids:
+                await send_cache_files(
+                    bot,
+                    message.chat.id,
+                    pipeline_item.cache_chat_id,
+                    pipeline_item.cache_file_ids,
+                    pipeline_item.cache_message_ids,
+                )
+            elif pipeline_item.cache_message_ids:
+                await forward_cache_messages(
+                    bot,
+                    message.chat.id,
+                    pipeline_item.cache_chat_id,
+                    pipeline_item.cache_message_ids,
+                )
+        except Exception:
+            fail_pipeline_item(context, pipeline_item)
+
+        if pipeline_item.failed:
+            error_count += 1
+
+        if pipeline_item.reply:
+            await bot.rate_limiter.call(
+                message.chat.id,
+                message.reply,
+                pipeline_item.reply,
+            )
+
+        bot.db.user.add_counters(
+            message.from_user.id,
+            songs_downloaded=pipeline_item.songs_downloaded,
+            music_videos_downloaded=pipeline_item.music_videos_downloaded,
         )
 
-    filtered_url_list = [
-        word for word in message.text.split() if VALID_URL_PATTERN.match(word)
-    ][:3]
+        # Deleting a delivered job spends its credit, failed items are
+        # refunded first
+        if pipeline_item.download_job_ids:
+            if pipeline_item.failed:
+                await refund_download_credits(context, pipeline_item.download_job_ids)
+            await bot.db.download_job.delete(pipeline_item.download_job_ids)
+            context.reserved_download_job_ids.difference_update(
+                pipeline_item.download_job_ids
+            )
 
-    if not filtered_url_list:
-        await message.reply(lp("download_no_url"))
-        return
+        if pipeline_item.abort:
+            return False, error_count
+
+    return True, error_count
+
+
+async def process_download_queue(
+    context: DownloadContext,
+    download_queue: AsyncIterator[tuple[list[DownloadItem], list[int]]],
+) -> tuple[bool, int]:
+    # Items flow through three stages so the next item can download while the
+    # previous one uploads; each stage handles items in queue order
+    upload_queue = asyncio.Queue(context.bot.download_pipeline_size)
+    delivery_queue = asyncio.Queue(context.bot.download_pipeline_size)
+    stages = [
+        asyncio.create_task(
+            download_stage(
+                context,
+                download_queue,
+                upload_queue,
+            )
+        ),
+        asyncio.create_task(upload_stage(context, upload_queue, delivery_queue)),
+    ]
+
+    try:
+        return await delivery_stage(context, delivery_queue)
+    finally:
+        for stage in stages:
+            stage.cancel()
+        await asyncio.gather(*stages, return_exceptions=True)
+
+        for queue in (upload_queue, delivery_queue):
+            while not queue.empty():
+                release_pipeline_items(context, [queue.get_nowait()])
+
+        # Credits of items that were not delivered go back to the user
+        await refund_download_credits(
+            context,
+            list(context.reserved_download_job_ids),
+        )
 
+
+def create_download_context(
+    bot: PinkMusicBot,
+    message: Message,
+    lp: Callable[..., str],
+    user: User,
+) -> DownloadContext:
     base_downloader = AppleMusicBaseDownloader(
         temp_path=bot.downloader_temp_path,
         ffmpeg_path=bot.downloader_ffmpeg_path,
@@ -147,7 +1164,7 @@ async def _message(bot: PinkMusicBot, message: Message, lp):
         mp4decrypt_path=bot.downloader_mp4decrypt_path,
         nm3u8dlre_path=bot.downloader_nm3u8dlre_path,
         amdecrypt_path=bot.downloader_amdecrypt_path,
-        wrapper_decrypt_ip=bot.downloader_wrapper_decrypt_ip,
+        wrapper_decrypt_ip=bot.downloader_wrapper_decrypt_ip[0],
         use_wrapper=user.song_codec != SongCodec.AAC_LEGACY,
         download_mode=bot.downloader_download_mode,
         remux_mode=bot.downloader_remux_mode,
@@ -186,434 +1203,708 @@ async def _message(bot: PinkMusicBot, message: Message, lp):
         skip_processing=True,
     )
 
-    error_count = 0
+    return DownloadContext(
+        bot=bot,
+        message=message,
+        lp=lp,
+        user=user,
+        interface=None,
+        base_downloader=base_downloader,
+        song_downloader=song_downloader,
+        music_video_downloader=music_video_downloader,
+        downloader=downloader,
+    )
 
-    for url in filtered_url_list:
-        url_message = await message.reply(
-            lp("download_url_processing").format(url=url),
-            disable_web_page_preview=True,
+
+def get_interface(
+    context: DownloadContext,
+    url: str,
+    url_info,
+) -> tuple[AppleMusicInterface, str | None]:
+    bot = context.bot
+    lp = context.lp
+
+    if (
+        context.user.song_codec != SongCodec.AAC_LEGACY
+        and url_info.type not in MUSIC_VIDEO_MEDIA_TYPE
+    ):
+        interface = bot.apple_music_wrapper_interface
+        if (
+            url_info.storefront.lower()
+            != bot.apple_music_wrapper_interface.apple_music_api.storefront.lower()
+        ):
+            return interface, lp("download_unsupported_wrapper_country").format(
+                url=url,
+                supported_country=bot.apple_music_wrapper_interface.apple_music_api.storefront.upper(),
+                supported_country_url=(
+                    f"https://music.apple.com/{bot.apple_music_wrapper_interface.apple_music_api.storefront.lower()}/new"
+                ),
+            )
+
+        return interface, None
+
+    interface = bot.apple_music_interfaces.get(
+        url_info.storefront.lower(),
+        next(iter(bot.apple_music_interfaces.values())),
+    )
+    if url_info.storefront.lower() not in bot.apple_music_interfaces:
+        return interface, lp("download_unsupported_country").format(
+            url=url,
+            default_country=interface.apple_music_api.storefront.upper(),
         )
-        url_download_queue = None
 
-        try:
-            url_info = downloader.get_url_info(url)
-
-            if url_info.type not in {
-                *SONG_MEDIA_TYPE,
-                *ALBUM_MEDIA_TYPE,
-                *PLAYLIST_MEDIA_TYPE,
-                *MUSIC_VIDEO_MEDIA_TYPE,
-            }:
-                await url_message.edit(
-                    lp("download_unsupported_url").format(media_type=url_info.type),
-                    disable_web_page_preview=True,
+    return interface, None
+
+
+class UrlDownloadQueue:
+    # Expands a URL into chunks of download items. Album and playlist pages
+    # are fetched and resolved one chunk at a time, so the first items can
+    # start downloading while later pages are still loading; chunks start
+    # small and grow so large playlists still resolve cache entries in bulk.
+    def __init__(
+        self,
+        context: DownloadContext,
+        url_info,
+        interface: AppleMusicInterface,
+    ):
+        self.context = context
+        self.url_info = url_info
+        self.interface = interface
+        # Only known up front when Apple reports it
+        self.total: int | None = None
+
+        context.interface = interface
+        context.song_downloader.interface = AppleMusicSongInterface(interface)
+        context.music_video_downloader.interface = AppleMusicMusicVideoInterface(
+            interface
+        )
+        context.downloader.interface = interface
+        context.downloader.flat_filter = self.flat_filter
+
+    async def flat_filter(self, media_metadata: dict):
+        # Cache entries are resolved for each chunk at once in
+        # resolve_cache_entries
+        if (
+            media_metadata["type"] not in SONG_MEDIA_TYPE
+            and not self.context.user.active_membership
+        ):
+            return self.context.lp("download_music_video_requires_membership")
+
+        return None
+
+    async def get_collection(self) -> dict | None:
+        url_info = self.url_info
+        apple_music_api = self.interface.apple_music_api
+
+        if url_info.sub_id or url_info.library_id or not url_info.id:
+            return None
+
+        if url_info.type in ALBUM_MEDIA_TYPE:
+            response = await apple_music_api.get_album(url_info.id)
+        elif url_info.type in PLAYLIST_MEDIA_TYPE:
+            response = await apple_music_api.get_playlist(url_info.id)
+        else:
+            return None
+
+        return response["data"][0] if response else {}
+
+    async def get_download_items(
+        self,
+        tracks_metadata: list[dict],
+        playlist_metadata: dict | None,
+    ) -> list[DownloadItem]:
+        semaphore = asyncio.Semaphore(DOWNLOAD_QUEUE_CONCURRENCY)
+
+        async def get_download_item(media_metadata: dict) -> DownloadItem:
+            async with semaphore:
+                return await self.context.downloader.get_single_download_item(
+                    media_metadata,
+                    playlist_metadata,
                 )
-                continue
 
-            if (
-                user.song_codec != SongCodec.AAC_LEGACY
-                and url_info.type not in MUSIC_VIDEO_MEDIA_TYPE
-            ):
-                interface = bot.apple_music_wrapper_interface
-                if (
-                    url_info.storefront.lower()
-                    != bot.apple_music_wrapper_interface.apple_music_api.storefront.lower()
-                ):
-                    await message.reply(
-                        lp("download_unsupported_wrapper_country").format(
-                            url=url,
-                            supported_country=bot.apple_music_wrapper_interface.apple_music_api.storefront.upper(),
-                            supported_country_url=(
-                                f"https://music.apple.com/{bot.apple_music_wrapper_interface.apple_music_api.storefront.lower()}/new"
-                            ),
-                        ),
-                        disable_web_page_preview=True,
-                    )
-
-            else:
-                interface = bot.apple_music_interfaces.get(
-                    url_info.storefront.lower(),
-                    next(iter(bot.apple_music_interfaces.values())),
+        download_items = await asyncio.gather(
+            *(get_download_item(media_metadata) for media_metadata in tracks_metadata)
+        )
+        await resolve_cache_entries(self.context.bot, self.context.user, download_items)
+        return download_items
+
+    async def chunks(self) -> AsyncIterator[list[DownloadItem]]:
+        collection = await self.get_collection()
+        if collection is None:
+            # Single items and library links are expanded in one go
+            url_download_queue = await self.context.downloader.get_download_queue(
+                self.url_info
+            )
+            if url_download_queue:
+                self.total = len(url_download_queue)
+                await resolve_cache_entries(
+                    self.context.bot,
+                    self.context.user,
+                    url_download_queue,
                 )
-                if url_info.storefront.lower() not in bot.apple_music_interfaces:
-                    await message.reply(
-                        lp("download_unsupported_country").format(
-                            url=url,
-                            default_country=interface.apple_music_api.storefront.upper(),
-                        ),
-                        disable_web_page_preview=True,
-                    )
+                yield url_download_queue
+            return
 
-            song_interface = AppleMusicSongInterface(interface)
-            music_video_interface = AppleMusicMusicVideoInterface(interface)
+        if not collection:
+            return
 
-            song_downloader.interface = song_interface
-            music_video_downloader.interface = music_video_interface
-            downloader.interface = interface
+        tracks = collection["relationships"]["tracks"]
+        if collection["type"] in ALBUM_MEDIA_TYPE:
+            self.total = collection["attributes"].get("trackCount")
+        elif not tracks.get("next"):
+            self.total = len(tracks["data"])
+        playlist_metadata = (
+            collection if collection["type"] in PLAYLIST_MEDIA_TYPE else None
+        )
 
-            async def flat_filter(media_metadata: dict):
-                if media_metadata["type"] in SONG_MEDIA_TYPE:
-                    return await bot.db.song.get(
-                        media_metadata["id"],
-                        user.song_codec,
-                    )
+        chunk_size = DOWNLOAD_QUEUE_FIRST_CHUNK_SIZE
+        tracks_metadata = list(tracks["data"])
+        # Only the current page is kept, the collection keeps the first one
+        # for the playlist tags
+        pages = self.interface.apple_music_api.extend_api_data(tracks)
+        while True:
+            while tracks_metadata:
+                chunk_tracks_metadata = tracks_metadata[:chunk_size]
+                del tracks_metadata[:chunk_size]
+                yield await self.get_download_items(
+                    chunk_tracks_metadata,
+                    playlist_metadata,
+                )
+                chunk_size = min(chunk_size * 2, DOWNLOAD_QUEUE_MAX_CHUNK_SIZE)
 
-                else:
-                    if not user.active_membership:
-                        return lp("download_music_video_requires_membership")
-
-                    return await bot.db.music_video.get(
-                        media_metadata["id"],
-                        fourk=(
-                            True
-                            if user.fourk_download
-                            and media_metadata["attributes"]["has4K"]
-                            else False
-                        ),
-                    )
+            page = await anext(pages, None)
+            if page is None:
+                return
+            tracks_metadata = list(page["data"])
 
-            downloader.flat_filter = flat_filter
+    async def prefetched_chunks(self) -> AsyncIterator[list[DownloadItem]]:
+        # The next chunk is resolved while the current one downloads
+        chunk_queue = asyncio.Queue(1)
 
-            url_download_queue = await downloader.get_download_queue(url_info)
-        except Exception:
-            logger.exception(f"{url}@{message.from_user.id}")
-            error_count += 1
-            await url_message.edit(
-                lp("download_url_processing_fail").format(url=url),
-                disable_web_page_preview=True,
+        async def produce() -> None:
+            try:
+                async for chunk in self.chunks():
+                    await chunk_queue.put(chunk)
+            except Exception as e:
+                await chunk_queue.put(e)
+                return
+            await chunk_queue.put(None)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while (chunk := await chunk_queue.get()) is not None:
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            producer.cancel()
+
+
+async def store_download_batch(
+    context: DownloadContext,
+    batch_id: str,
+    url: str,
+    url_download_queue: list[DownloadItem],
+    first_position: int = 0,
+    worker_id: str | None = None,
+    expanded: bool = True,
+) -> list[int]:
+    bot = context.bot
+    message = context.message
+
+    download_job_ids = await bot.db.download_job.add_batch(
+        batch_id,
+        message.from_user.id,
+        message.chat.id,
+        message.id,
+        url,
+        [download_item.media_metadata["id"] for download_item in url_download_queue],
+        first_position,
+        worker_id,
+        0 if context.user.active_membership else 1,
+        expanded,
+    )
+    if worker_id is None:
+        bot.download_job_queue.notify()
+    return download_job_ids
+
+
+async def submit_download_batch(
+    context: DownloadContext,
+    url: str,
+    first_chunk: list[DownloadItem],
+    chunks: AsyncIterator[list[DownloadItem]],
+) -> tuple[bool, int]:
+    bot = context.bot
+
+    # Batches of this process run right in the handler, so they are only
+    # limited by the priority semaphores. Their jobs are stored as claimed by
+    # this process and handed to the workers after a restart.
+    batch_id = uuid.uuid4().hex
+    cancelled = False
+    try:
+        async with aclosing(
+            iter_submitted_download_queue(
+                context,
+                url,
+                batch_id,
+                f"{bot.download_worker_prefix}handler",
+                first_chunk,
+                chunks,
             )
-            continue
+        ) as download_queue:
+            return await process_download_queue(context, download_queue)
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    finally:
+        # Jobs left over after an abort are not resumed, unlike the ones of
+        # a process that is stopping
+        if not cancelled:
+            await bot.db.download_job.delete_batch(batch_id)
+
+
+async def iter_submitted_download_queue(
+    context: DownloadContext,
+    url: str,
+    batch_id: str,
+    worker_id: str,
+    first_chunk: list[DownloadItem],
+    chunks: AsyncIterator[list[DownloadItem]],
+) -> AsyncIterator[tuple[list[DownloadItem], list[int]]]:
+    async with aclosing(chunks):
+        yield first_chunk, await store_download_batch(
+            context,
+            batch_id,
+            url,
+            first_chunk,
+            0,
+            worker_id,
+            False,
+        )
 
-        if not url_download_queue:
-            await url_message.edit(
-                lp("download_nothing_found").format(url=url),
-                disable_web_page_preview=True,
+        # Later chunks are stored as they are resolved, a restart before the
+        # expansion finished continues it from the last stored position
+        position = len(first_chunk)
+        async for chunk in chunks:
+            yield chunk, await store_download_batch(
+                context,
+                batch_id,
+                url,
+                chunk,
+                position,
+                worker_id,
+                False,
             )
-            return
+            position += len(chunk)
+
+    await context.bot.db.download_job.finish_expansion(batch_id)
+
+
+async def iter_pending_download_queue(
+    context: DownloadContext,
+    chunks: AsyncIterator[list[DownloadItem]],
+    download_jobs: list[DownloadJob],
+) -> AsyncIterator[tuple[list[DownloadItem], list[int]]]:
+    # Batches stored by a frontend process or left over from a restart are
+    # expanded again, and only the items that were not delivered yet are
+    # kept. Items past the expansion job were never stored, so they are
+    # stored and kept as they are found.
+    batch_id = download_jobs[0].batch_id
+    url = download_jobs[0].url
+    worker_id = download_jobs[0].worker_id
+    expansion_position = None
+    pending_download_job_ids = {}
+    remaining = 0
+    for download_job in download_jobs:
+        if download_job.is_expansion:
+            expansion_position = download_job.position
+            continue
 
-        await url_message.edit(
-            lp("download_start").format(total=len(url_download_queue))
+        pending_download_job_ids.setdefault(download_job.media_id, deque()).append(
+            download_job.id
         )
+        remaining += 1
+
+    position = 0
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            stored_count = (
+                len(chunk)
+                if expansion_position is None
+                else max(0, min(len(chunk), expansion_position - position))
+            )
+            pending_download_queue = []
+            download_job_ids = []
+            for download_item in chunk[:stored_count]:
+                media_download_job_ids = pending_download_job_ids.get(
+                    download_item.media_metadata["id"]
+                )
+                if media_download_job_ids:
+                    pending_download_queue.append(download_item)
+                    download_job_ids.append(media_download_job_ids.popleft())
+            remaining -= len(download_job_ids)
+
+            if stored_count < len(chunk):
+                pending_download_queue.extend(chunk[stored_count:])
+                download_job_ids.extend(
+                    await store_download_batch(
+                        context,
+                        batch_id,
+                        url,
+                        chunk[stored_count:],
+                        position + stored_count,
+                        worker_id,
+                        False,
+                    )
+                )
+            position += len(chunk)
 
-        for download_item in url_download_queue:
-            skip_credit_deduct = user.active_membership
-            media_id = download_item.media_metadata["id"]
-            media_title = download_item.media_metadata["attributes"]["name"]
+            if pending_download_queue:
+                yield pending_download_queue, download_job_ids
 
-            if await bot.is_under_maintenance(message):
+            # The rest of a large playlist is not expanded once every
+            # pending item was found, unless it was never stored
+            if expansion_position is None and not remaining:
                 return
 
-            if user.credits <= 0 and not user.active_membership:
-                await message.reply(lp("download_no_credits"))
-                return
+    if expansion_position is not None:
+        await context.bot.db.download_job.finish_expansion(batch_id)
 
-            if isinstance(download_item.flat_filter_result, str):
-                await message.reply(download_item.flat_filter_result)
-                continue
 
-            try:
-                if isinstance(download_item.flat_filter_result, Song):
-                    database_entry = download_item.flat_filter_result
-                    song_cache_message = await bot.get_messages(
-                        bot.song_cache_chat_id,
-                        database_entry.message_id_song,
-                    )
+async def prepend_download_queue(
+    first: tuple[list[DownloadItem], list[int]],
+    download_queue: AsyncIterator[tuple[list[DownloadItem], list[int]]],
+) -> AsyncIterator[tuple[list[DownloadItem], list[int]]]:
+    async with aclosing(download_queue):
+        yield first
+        async for chunk in download_queue:
+            yield chunk
 
-                    if database_entry.message_id_synced_lyrics:
-                        synced_lyrics_cache_message = await bot.get_messages(
-                            bot.song_cache_chat_id,
-                            database_entry.message_id_synced_lyrics,
-                        )
-                    else:
-                        synced_lyrics_cache_message = None
-
-                    # Song cache is valid if:
-                    cache_is_valid = (
-                        # - The song message exists
-                        not song_cache_message.empty
-                        # - The lyrics message exists if lyrics are available
-                        and not (
-                            not database_entry.message_id_synced_lyrics
-                            and (download_item.lyrics and download_item.lyrics.synced)
-                        )
-                        # - The lyrics message exists if lyrics are stored
-                        and (
-                            not database_entry.message_id_synced_lyrics
-                            or (
-                                synced_lyrics_cache_message
-                                and not synced_lyrics_cache_message.empty
-                            )
-                        )
-                        # - The song message caption contains the ID
-                        and song_cache_message.caption.find(
-                            download_item.media_metadata["id"]
-                        )
-                        != -1
-                    )
 
-                    if cache_is_valid:
-                        await bot.copy_message(
-                            message.chat.id,
-                            bot.song_cache_chat_id,
-                            database_entry.message_id_song,
-                            "",
-                        )
-                        if (
-                            database_entry.message_id_synced_lyrics
-                            and synced_lyrics_cache_message
-                            and not synced_lyrics_cache_message.empty
-                            and user.synced_lyrics_file_upload
-                        ):
-                            await bot.copy_message(
-                                message.chat.id,
-                                bot.song_cache_chat_id,
-                                database_entry.message_id_synced_lyrics,
-                                "",
-                            )
-
-                        await bot.db.user.increment_songs_downloaded(
-                            message.from_user.id
-                        )
-                        continue
+async def process_stored_download_batch(
+    bot: PinkMusicBot,
+    download_jobs: list[DownloadJob],
+) -> None:
+    download_job = download_jobs[0]
+
+    message = await bot.rate_limiter.call(
+        None,
+        bot.get_messages,
+        download_job.chat_id,
+        download_job.message_id,
+    )
+    if message.empty:
+        return
 
-                if isinstance(download_item.flat_filter_result, MusicVideo):
-                    database_entry = download_item.flat_filter_result
+    user = await bot.db.user.get(download_job.user_id)
+    if user is None:
+        return
 
-                    if database_entry.too_large:
-                        await message.reply(
-                            lp("download_too_large").format(title=media_title)
-                        )
-                        continue
+    if not user.active_membership:
+        user.song_codec = SongCodec.AAC_LEGACY
 
-                    music_video_cache_message = await bot.get_messages(
-                        bot.song_cache_chat_id,
-                        database_entry.message_id,
-                    )
+    lp = bot.get_lp(message)
+    context = create_download_context(bot, message, lp, user)
+    # Credits reserved before a crash are used instead of reserving again
+    context.reserved_download_job_ids.update(
+        download_job.id
+        for download_job in download_jobs
+        if download_job.credits_reserved_at is not None
+    )
+    url_info = context.downloader.get_url_info(download_job.url)
+    interface, _ = get_interface(context, download_job.url, url_info)
+    url_download_queue = UrlDownloadQueue(context, url_info, interface)
+    pending_download_queue = iter_pending_download_queue(
+        context,
+        url_download_queue.prefetched_chunks(),
+        download_jobs,
+    )
 
-                    # Music video cache is valid if:
-                    cache_is_valid = (
-                        # - The music video message exists
-                        not music_video_cache_message.empty
-                        # - The music video message caption contains the ID
-                        and music_video_cache_message.caption.find(
-                            download_item.media_metadata["id"]
-                        )
-                        != -1
-                    )
+    try:
+        first = await anext(pending_download_queue, None)
+    except Exception:
+        logger.exception(f"{download_job.url}@{user.id}")
+        await pending_download_queue.aclose()
+        await bot.rate_limiter.call(
+            message.chat.id,
+            message.reply,
+            lp("download_url_processing_fail").format(url=download_job.url),
+            disable_web_page_preview=True,
+        )
+        return
 
-                    if cache_is_valid:
-                        await bot.copy_message(
-                            message.chat.id,
-                            bot.song_cache_chat_id,
-                            database_entry.message_id,
-                            "",
-                        )
+    if first is None:
+        # Batches stored by a frontend process are only expanded here
+        if all(
+            download_job.is_expansion and not download_job.position
+            for download_job in download_jobs
+        ):
+            await bot.rate_limiter.call(
+                message.chat.id,
+                message.reply,
+                lp("download_nothing_found").format(url=download_job.url),
+                disable_web_page_preview=True,
+            )
+        return
 
-                        await bot.db.user.increment_music_videos_downloaded(
-                            message.from_user.id
-                        )
-                        continue
+    user_lock = (
+        nullcontext()
+        if bot.user_locker.is_user_locked(user.id)
+        else bot.user_locker.acquire_user_lock(user.id)
+    )
+    async with user_lock, aclosing(
+        prepend_download_queue(first, pending_download_queue)
+    ) as download_queue:
+        completed, error_count = await process_download_queue(context, download_queue)
 
-                download_item = await enqueue_download(
-                    bot,
-                    downloader,
-                    download_item,
-                    user.song_codec != SongCodec.AAC_LEGACY
-                    and download_item.media_metadata["type"] in SONG_MEDIA_TYPE,
-                    user.active_membership,
-                )
+    if not completed:
+        return
 
-                if download_item.cover_url_template:
-                    cover_url_telegram = base_downloader.format_cover_url(
-                        download_item.cover_url_template,
-                        300,
-                        "jpg",
-                    )
-                    cover_data = await base_downloader.get_cover_bytes(
-                        cover_url_telegram,
-                    )
-                    cover_bytes_telegram = BytesIO(cover_data) if cover_data else None
-                else:
-                    cover_bytes_telegram = None
-
-                if download_item.media_metadata["type"] in SONG_MEDIA_TYPE:
-                    caption_song = " ".join(
-                        [
-                            f"<code>{download_item.media_metadata['id']}</code>",
-                            f"<code>{interface.apple_music_api.storefront.upper()}</code>",
-                            f"<code>{user.song_codec.value}</code>",
-                            "<code>song</code>",
-                        ]
-                    )
-                    if download_item.lyrics and download_item.lyrics.synced:
-                        caption_lyrics = " ".join(
-                            [
-                                f"<code>{download_item.media_metadata['id']}</code>",
-                                f"<code>{interface.apple_music_api.storefront.upper()}</code>",
-                                f"<code>{user.song_codec.value}</code>",
-                                "<code>lyrics</code>",
-                            ]
-                        )
-                    else:
-                        caption_lyrics = None
-
-                    with open(download_item.staged_path, "rb") as f:
-                        audio_bytes = BytesIO(f.read())
-
-                    message_song = await enqueue_upload_audio(
-                        bot,
-                        user.active_membership,
-                        chat_id=bot.song_cache_chat_id,
-                        audio=audio_bytes,
-                        thumb=cover_bytes_telegram,
-                        caption=caption_song,
-                        duration=download_item.media_metadata["attributes"][
-                            "durationInMillis"
-                        ]
-                        // 1000,
-                        performer=download_item.media_tags.artist,
-                        title=download_item.media_tags.title,
-                        file_name=os.path.basename(download_item.final_path),
-                    )
-                    if caption_lyrics:
-                        message_lyrics = await enqueue_upload_document(
-                            bot,
-                            user.active_membership,
-                            chat_id=bot.song_cache_chat_id,
-                            document=BytesIO(
-                                download_item.lyrics.synced.encode("utf-8")
-                            ),
-                            caption=caption_lyrics,
-                            file_name=os.path.basename(
-                                song_downloader.get_lyrics_synced_path(
-                                    download_item.final_path
-                                )
-                            ),
-                        )
-                    else:
-                        message_lyrics = None
+    # Each stored batch holds a single URL, so a message with several links
+    # gets one completion reply per link here, unlike the single reply of
+    # _message in the all mode
+    if error_count == 0:
+        await bot.rate_limiter.call(
+            message.chat.id,
+            message.reply,
+            lp("download_complete"),
+        )
+    else:
+        await bot.rate_limiter.call(
+            message.chat.id,
+            message.reply,
+            lp("download_complete_but"),
+        )
 
-                    await bot.db.song.add_if_not_exists(
-                        download_item.media_metadata["id"],
-                        user.song_codec,
-                        message_song.id,
-                        message_lyrics.id if message_lyrics else None,
-                    )
 
-                    await bot.copy_message(
-                        message.chat.id,
-                        bot.song_cache_chat_id,
-                        message_song.id,
-                        "",
-                    )
-                    if message_lyrics and user.synced_lyrics_file_upload:
-                        await bot.copy_message(
-                            message.chat.id,
-                            bot.song_cache_chat_id,
-                            message_lyrics.id,
-                            "",
-                        )
+@PinkMusicBot.on_download_batch
+async def download_batch(bot: PinkMusicBot, download_jobs: list[DownloadJob]):
+    cancelled = False
+    try:
+        await process_stored_download_batch(bot, download_jobs)
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    finally:
+        # Jobs left over after an abort are not resumed, unlike the ones of
+        # a process that is stopping. Jobs of a batch that ended early still
+        # hold the credits reserved before a crash.
+        if not cancelled:
+            await bot.db.user.refund_credits(
+                download_jobs[0].user_id,
+                [download_job.id for download_job in download_jobs],
+                bot.free_daily_credits,
+            )
+            await bot.db.download_job.delete_batch(download_jobs[0].batch_id)
 
-                    await bot.db.user.increment_songs_downloaded(message.from_user.id)
 
-                else:
-                    file_size = os.path.getsize(download_item.staged_path)
-                    max_file_size = 2000 * 1024 * 1024
-                    fourk = (
-                        user.fourk_download
-                        and download_item.media_metadata["attributes"]["has4K"]
-                    )
+@PinkMusicBot.on_message(
+    filters.text
+    & (filters.private | filters.group)
+    & (filters.command("download") | filters.regex(r"^(?!/)"))
+)
+async def message(bot: PinkMusicBot, message: Message):
+    lp = bot.get_lp(message)
 
-                    if file_size > max_file_size:
-                        await message.reply(
-                            lp("download_too_large").format(title=media_title)
-                        )
-                        await bot.db.music_video.add_if_not_exists(
-                            download_item.media_metadata["id"],
-                            fourk,
-                            None,
-                            True,
-                        )
-                        continue
-
-                    caption_mv = " ".join(
-                        [
-                            f"<code>{download_item.media_metadata['id']}</code>",
-                            f"<code>{interface.apple_music_api.storefront.upper()}</code>",
-                            f"<code>{'uhd' if fourk else 'hd'}</code>",
-                            "<code>music_video</code>",
-                        ]
-                    )
+    # Download workers in other processes run the user's jobs without
+    # holding this process' user lock
+    if bot.user_locker.is_user_locked(message.from_user.id) or (
+        bot.bot_mode == BotMode.FRONTEND
+        and await bot.db.download_job.has_user_jobs(message.from_user.id)
+    ):
+        await bot.rate_limiter.call(
+            message.chat.id,
+            message.reply,
+            lp("download_pending"),
+        )
+        return
 
-                    with open(download_item.staged_path, "rb") as f:
-                        video_bytes = BytesIO(f.read())
-
-                    message_music_video = await enqueue_upload_video(
-                        bot,
-                        user.active_membership,
-                        chat_id=bot.music_video_cache_chat_id,
-                        video=video_bytes,
-                        thumb=cover_bytes_telegram,
-                        caption=caption_mv,
-                        duration=download_item.media_metadata["attributes"][
-                            "durationInMillis"
-                        ]
-                        // 1000,
-                        file_name=os.path.basename(download_item.final_path),
-                        supports_streaming=True,
-                    )
+    async with bot.user_locker.acquire_user_lock(message.from_user.id):
+        await _message(bot, message, lp)
 
-                    await bot.db.music_video.add_if_not_exists(
-                        download_item.media_metadata["id"],
-                        fourk,
-                        message_music_video.id,
-                    )
 
-                    await bot.copy_message(
-                        message.chat.id,
-                        bot.music_video_cache_chat_id,
-                        message_music_video.id,
-                        "",
-                    )
-                    await bot.db.user.increment_music_videos_downloaded(
-                        message.from_user.id
-                    )
-            except FormatNotAvailable:
-                await message.reply(
-                    lp("download_format_unavailable").format(title=media_title)
-                )
-                continue
-            except NotStreamable:
-                await message.reply(
-                    lp("download_unstremeable").format(title=media_title)
-                )
-                continue
-            except asyncio.TimeoutError:
-                await message.reply(lp("download_timeout"))
-                return
-            except Exception:
-                logger.exception(f"{media_id}@{message.from_user.id}")
-                error_count += 1
-                skip_credit_deduct = True
-                await message.reply(lp("download_fail").format(title=media_title))
-                continue
-            finally:
-                if isinstance(download_item, DownloadItem):
-                    base_downloader.cleanup_temp(download_item.random_uuid)
-
-                if not isinstance(
-                    download_item.flat_filter_result, Song
-                ) or not isinstance(download_item.flat_filter_result, MusicVideo):
-                    await asyncio.sleep(5)
-
-                if not skip_credit_deduct:
-                    user.credits -= 1
-                    await bot.db.user.deduct_credits(
-                        message.from_user.id,
-                        1,
-                    )
+async def _message(bot: PinkMusicBot, message: Message, lp):
+    if await bot.is_under_maintenance(message):
+        return
 
-    if error_count == 0:
-        await message.reply(lp("download_complete"))
+    # Loaded under the user lock so the credits of a previous download are
+    # already accounted for
+    user = await bot.load_user(message)
+
+    if user.credits <= 0 and not user.active_membership:
+        await bot.rate_limiter.call(
+            message.chat.id,
+            message.reply,
+            lp("download_no_credits"),
+        )
+        return
+
+    if not user.active_membership and user.song_codec != SongCodec.AAC_LEGACY:
+        await bot.rate_limiter.call(
+            message.chat.id,
+            message.reply,
+            lp("download_songcodec_fallback"),
+        )
+        user.song_codec = SongCodec.AAC_LEGACY
+        await bot.db.user.update_song_codec(
+            user.id,
+            SongCodec.AAC_LEGACY,
+        )
+
+    filtered_url_list = [
+        word for word in message.text.split() if VALID_URL_PATTERN.match(word)
+    ][:3]
+
+    if not filtered_url_list:
+        await bot.rate_limiter.call(
+            message.chat.id,
+            message.reply,
+            lp("download_no_url"),
+        )
+        return
+
+    # Progress messages are sent up front so they keep the order of the
+    # links, then every link runs as its own sub-job with its own downloader.
+    # Each sub-job reserves its credits in the database, so the budget holds
+    # across them.
+    url_messages = [
+        await bot.rate_limiter.call(
+            message.chat.id,
+            message.reply,
+            lp("download_url_processing").format(url=url),
+            disable_web_page_preview=True,
+        )
+        for url in filtered_url_list
+    ]
+    results = await asyncio.gather(
+        *(
+            process_url(
+                create_download_context(bot, message, lp, user),
+                url,
+                url_message,
+            )
+            for url, url_message in zip(filtered_url_list, url_messages)
+        ),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    # Worker processes report the completion of each stored batch, that is
+    # of each link, themselves
+    if bot.bot_mode == BotMode.FRONTEND:
+        return
+
+    if not all(url_completed for url_completed, _ in results):
+        return
+
+    if sum(url_error_count for _, url_error_count in results) == 0:
+        await bot.rate_limiter.call(
+            message.chat.id,
+            message.reply,
+            lp("download_complete"),
+        )
     else:
-        await message.reply(lp("download_complete_but"))
+        await bot.rate_limiter.call(
+            message.chat.id,
+            message.reply,
+            lp("download_complete_but"),
+        )
+
+
+async def process_url(
+    context: DownloadContext,
+    url: str,
+    url_message: Message,
+) -> tuple[bool, int]:
+    bot = context.bot
+    message = context.message
+    lp = context.lp
+    first_chunk = None
+
+    try:
+        url_info = context.downloader.get_url_info(url)
+
+        if url_info.type not in {
+            *SONG_MEDIA_TYPE,
+            *ALBUM_MEDIA_TYPE,
+            *PLAYLIST_MEDIA_TYPE,
+            *MUSIC_VIDEO_MEDIA_TYPE,
+        }:
+            await bot.rate_limiter.call(
+                url_message.chat.id,
+                url_message.edit,
+                lp("download_unsupported_url").format(media_type=url_info.type),
+                disable_web_page_preview=True,
+            )
+            return True, 0
+
+        interface, interface_warning = get_interface(context, url, url_info)
+        if interface_warning:
+            await bot.rate_limiter.call(
+                message.chat.id,
+                message.reply,
+                interface_warning,
+                disable_web_page_preview=True,
+            )
+
+        if bot.bot_mode == BotMode.FRONTEND:
+            # Only the URL is stored, the worker that claims the batch
+            # expands it
+            await store_download_batch(
+                context,
+                uuid.uuid4().hex,
+                url,
+                [],
+                expanded=False,
+            )
+            await bot.rate_limiter.call(
+                url_message.chat.id,
+                url_message.edit,
+                lp("download_start_streaming"),
+            )
+            return True, 0
+
+        url_download_queue = UrlDownloadQueue(context, url_info, interface)
+        chunks = url_download_queue.prefetched_chunks()
+        first_chunk = await anext(chunks, None)
+    except Exception:
+        logger.exception(f"{url}@{message.from_user.id}")
+        await bot.rate_limiter.call(
+            url_message.chat.id,
+            url_message.edit,
+            lp("download_url_processing_fail").format(url=url),
+            disable_web_page_preview=True,
+        )
+        return True, 1
+
+    if not first_chunk:
+        await bot.rate_limiter.call(
+            url_message.chat.id,
+            url_message.edit,
+            lp("download_nothing_found").format(url=url),
+            disable_web_page_preview=True,
+        )
+        return False, 0
+
+    if url_download_queue.total is not None:
+        await bot.rate_limiter.call(
+            url_message.chat.id,
+            url_message.edit,
+            lp("download_start").format(total=url_download_queue.total),
+        )
+    else:
+        await bot.rate_limiter.call(
+            url_message.chat.id,
+            url_message.edit,
+            lp("download_start_streaming"),
+        )
+
+    return await submit_download_batch(
+        context,
+        url,
+        first_chunk,
+        chunks,
+    )
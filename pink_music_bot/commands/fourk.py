@@ -8,7 +8,7 @@ from ..bot import PinkMusicBot
     filters.text & (filters.private | filters.group) & filters.command("fourk")
 )
 async def message(bot: PinkMusicBot, message: Message):
-    await bot.ensure_user_exists(message)
+    await bot.load_user(message)
     lp = bot.get_lp(message)
 
     result = await bot.db.user.toggle_fourk_download(message.from_user.id)
@@ -8,7 +8,7 @@ from ..bot import PinkMusicBot
     filters.text & (filters.private | filters.group) & filters.command("lyrics")
 )
 async def message(bot: PinkMusicBot, message: Message):
-    await bot.ensure_user_exists(message)
+    await bot.load_user(message)
     lp = bot.get_lp(message)
 
     result = await bot.db.user.toggle_synced_lyrics_file_upload(message.from_user.id)
@@ -9,11 +9,9 @@ from ..constants import SONG_CODEC_MAP
     filters.text & (filters.private | filters.group) & filters.command("me")
 )
 async def message(bot: PinkMusicBot, message: Message):
-    await bot.ensure_user_exists(message)
-    await bot.add_free_daily_credits(message)
     lp = bot.get_lp(message)
 
-    user = await bot.db.user.get(message.from_user.id)
+    user = await bot.load_user(message)
     await message.reply(
         lp("me").format(
             user_id=user.id,
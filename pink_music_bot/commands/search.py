@@ -206,9 +206,8 @@ async def get_search_results(
 
 @PinkMusicBot.on_inline_query()
 async def inline_query_handler(bot: PinkMusicBot, inline_query: InlineQuery):
-    await bot.ensure_user_exists(inline_query)
     lp = bot.get_lp(inline_query)
-    user = await bot.db.user.get(inline_query.from_user.id)
+    user = await bot.load_user(inline_query)
     country_code = user.search_country
     if country_code.lower() not in bot.apple_music_interfaces:
         country_code = next(iter(bot.apple_music_interfaces.keys()))
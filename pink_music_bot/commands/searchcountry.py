@@ -31,9 +31,8 @@ def get_reply_markup(
     filters.text & (filters.private | filters.group) & filters.command("searchcountry")
 )
 async def message(bot: PinkMusicBot, message: Message):
-    await bot.ensure_user_exists(message)
     lp = bot.get_lp(message)
-    user = await bot.db.user.get(message.from_user.id)
+    user = await bot.load_user(message)
 
     await message.reply(
         lp("search_country_choose"),
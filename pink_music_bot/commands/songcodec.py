@@ -30,9 +30,8 @@ def get_reply_markup(current_song_codec: str) -> InlineKeyboardMarkup:
     filters.text & (filters.private | filters.group) & filters.command("songcodec")
 )
 async def message(bot: PinkMusicBot, message: Message):
-    await bot.ensure_user_exists(message)
     lp = bot.get_lp(message)
-    user = await bot.db.user.get(message.from_user.id)
+    user = await bot.load_user(message)
     if not user.active_membership:
         await message.reply(lp("songcodec_membership_required"))
         return
@@ -22,6 +22,7 @@ from pyrogram import filters
 from pyrogram.types import Message
 
 from ..bot import PinkMusicBot
+from ..database import User
 
 logger = logging.getLogger(__name__)
 
@@ -31,18 +32,16 @@ logger = logging.getLogger(__name__)
 )
 async def message(bot: PinkMusicBot, message: Message):
     lp = bot.get_lp(message)
-    await bot.ensure_user_exists(message)
+    user = await bot.load_user(message)
 
     if not bot.is_admin(message):
         await message.reply(lp("not_admin"))
         return
 
-    await _message(bot, message, lp)
+    await _message(bot, message, lp, user)
 
 
-async def _message(bot: PinkMusicBot, message: Message, lp):
-    user = await bot.db.user.get(message.from_user.id)
-
+async def _message(bot: PinkMusicBot, message: Message, lp, user: User):
     filtered_url_list = [
         word for word in message.command[1:] if VALID_URL_PATTERN.match(word)
     ][:3]
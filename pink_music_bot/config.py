@@ -14,6 +14,8 @@ from gamdl.interface import SyncedLyricsFormat
 
 from dotenv import load_dotenv
 
+from .constants import BotMode
+
 api_create_from_netscape_cookies_sig = inspect.signature(
     AppleMusicApi.create_from_netscape_cookies
 )
@@ -26,10 +28,22 @@ load_dotenv()
 api_id = os.environ["API_ID"]
 api_hash = os.environ["API_HASH"]
 bot_token = os.environ["BOT_TOKEN"]
+helper_bot_tokens = (
+    os.environ["HELPER_BOT_TOKENS"].split(",")
+    if "HELPER_BOT_TOKENS" in os.environ
+    else []
+)
 max_concurrent_transmissions = int(os.environ.get("MAX_CONCURRENT_TRANSMISSIONS", 6))
+upload_connections = int(os.environ.get("UPLOAD_CONNECTIONS", 1))
 database_url = os.environ.get("DATABASE_URL", "sqlite+aiosqlite:///pink_music_bot.db")
+user_cache_size = int(os.environ.get("USER_CACHE_SIZE", 10000))
+user_cache_ttl = int(os.environ.get("USER_CACHE_TTL", 60))
+user_counters_flush_interval = float(
+    os.environ.get("USER_COUNTERS_FLUSH_INTERVAL", 5)
+)
 force_english = bool(os.environ.get("FORCE_ENGLISH"))
 free_daily_credits = int(os.environ.get("FREE_DAILY_CREDITS", 50))
+free_credits_refresh_interval = int(os.environ.get("FREE_CREDITS_REFRESH_INTERVAL", 0))
 admin_user_id = int(os.environ["ADMIN_USER_ID"])
 media_user_tokens = os.environ["MEDIA_USER_TOKENS"].split(":")
 wrapper_account_url = os.environ.get("WRAPPER_ACCOUNT_URL")
@@ -45,6 +59,26 @@ kofi_verification_token = os.environ.get(
 kofi_shop_id = os.environ.get("KOFI_SHOP_ID", "abcde12345")
 kofi_url = os.environ.get("KOFI_URL", "example.com")
 download_timeout = int(os.environ.get("DOWNLOAD_TIMEOUT", 300))
+download_pipeline_size = int(os.environ.get("DOWNLOAD_PIPELINE_SIZE", 2))
+download_workers = int(os.environ.get("DOWNLOAD_WORKERS", 10))
+music_video_size_margin = float(os.environ.get("MUSIC_VIDEO_SIZE_MARGIN", 0.1))
+download_disk_budget = int(os.environ.get("DOWNLOAD_DISK_BUDGET", 0)) * 1024 * 1024
+download_min_free_space = (
+    int(os.environ.get("DOWNLOAD_MIN_FREE_SPACE", 1024)) * 1024 * 1024
+)
+metadata_cache_ttl = int(os.environ.get("METADATA_CACHE_TTL", 3600))
+metadata_cache_size = int(os.environ.get("METADATA_CACHE_SIZE", 10000))
+cover_cache_size = int(os.environ.get("COVER_CACHE_SIZE", 64)) * 1024 * 1024
+cover_cache_path = os.environ.get("COVER_CACHE_PATH")
+cover_cache_disk_size = (
+    int(os.environ.get("COVER_CACHE_DISK_SIZE", 1024)) * 1024 * 1024
+)
+bot_mode = BotMode(os.environ.get("BOT_MODE", BotMode.ALL.value))
+worker_processes = int(os.environ.get("WORKER_PROCESSES", 1))
+fair_scheduling = os.environ.get("FAIR_SCHEDULING", "0") != "0"
+priority_aging_interval = float(os.environ.get("PRIORITY_AGING_INTERVAL", 60))
+rate_limit = float(os.environ.get("RATE_LIMIT", 25))
+chat_rate_limit = float(os.environ.get("CHAT_RATE_LIMIT", 1))
 song_cache_chat_id = int(os.environ["SONG_CACHE_CHAT_ID"])
 music_video_cache_id = int(
     os.environ.get("MUSIC_VIDEO_CACHE_CHAT_ID", song_cache_chat_id)
@@ -140,7 +174,12 @@ downloader_amdecrypt_path = os.environ.get(
     "DOWNLOADER_AMDECRYPT_PATH",
     base_downloader_sig.parameters["amdecrypt_path"].default,
 )
-downloader_wrapper_decrypt_ip = os.environ.get(
-    "DOWNLOADER_WRAPPER_DECRYPT_IP",
-    base_downloader_sig.parameters["wrapper_decrypt_ip"].default,
+downloader_wrapper_decrypt_ip = (
+    os.environ["DOWNLOADER_WRAPPER_DECRYPT_IP"].split(",")
+    if "DOWNLOADER_WRAPPER_DECRYPT_IP" in os.environ
+    else [base_downloader_sig.parameters["wrapper_decrypt_ip"].default]
+)
+wrapper_concurrency = int(os.environ.get("WRAPPER_CONCURRENCY", 1))
+wrapper_health_check_interval = int(
+    os.environ.get("WRAPPER_HEALTH_CHECK_INTERVAL", 30)
 )
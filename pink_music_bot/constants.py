@@ -1,6 +1,14 @@
+from enum import Enum
+
 SONG_CODEC_MAP = {
     "aac-legacy": "AAC",
     "alac": "ALAC",
     "aac-binaural": "Binaural AAC",
     "atmos": "Dolby Atmos",
 }
+
+
+class BotMode(Enum):
+    ALL = "all"
+    FRONTEND = "frontend"
+    WORKER = "worker"
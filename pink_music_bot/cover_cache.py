@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class CoverCache:
+    # Least recently used cache of cover thumbnails keyed on the artwork URL
+    # template and size. Evicted covers can still be found in the optional
+    # disk tier, which is bounded separately. The disk tier can be shared by
+    # several processes, so a missing file is treated as a miss.
+    def __init__(
+        self,
+        max_bytes: int,
+        disk_path: str | None = None,
+        disk_max_bytes: int = 0,
+    ):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple[str, int], bytes] = OrderedDict()
+        self.size = 0
+        self.disk_path = Path(disk_path) if disk_path else None
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_entries: OrderedDict[str, int] = OrderedDict()
+        self.disk_size = 0
+        self.fetches: dict[tuple[str, int], asyncio.Future[None]] = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_path is not None:
+            self.load_disk_entries()
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.disk_hits + self.misses
+        return (self.hits + self.disk_hits) / requests if requests else 0.0
+
+    def load_disk_entries(self) -> None:
+        self.disk_path.mkdir(parents=True, exist_ok=True)
+        cover_paths = sorted(
+            (
+                cover_path
+                for cover_path in self.disk_path.iterdir()
+                if cover_path.is_file() and not cover_path.name.endswith(".tmp")
+            ),
+            key=lambda cover_path: cover_path.stat().st_mtime,
+        )
+        for cover_path in cover_paths:
+            self.add_disk_entry(cover_path.name, cover_path.stat().st_size)
+        self.evict_disk()
+
+        if self.disk_entries:
+            logger.info(f"Loaded {len(self.disk_entries)} cached covers from disk")
+
+    def get_disk_name(self, key: tuple[str, int]) -> str:
+        return hashlib.sha1(f"{key[0]}:{key[1]}".encode()).hexdigest()
+
+    async def get(
+        self,
+        url_template: str,
+        size: int,
+        fetch: Callable[[], Awaitable[bytes | None]],
+    ) -> bytes | None:
+        key = (url_template, size)
+
+        # Tracks of the same album usually ask for the cover at the same
+        # time, so they wait for the first one and look again
+        while (fetch_future := self.fetches.get(key)) is not None:
+            await asyncio.shield(fetch_future)
+
+        data = self.entries.get(key)
+        if data is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+        self.fetches[key] = asyncio.get_running_loop().create_future()
+        try:
+            data = await self.get_disk(key)
+            if data is not None:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+                data = await fetch()
+                if data:
+                    await self.put_disk(key, data)
+            if data:
+                self.put(key, data)
+        finally:
+            self.fetches.pop(key).set_result(None)
+
+        return data
+
+    def put(self, key: tuple[str, int], data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted_data = self.entries.popitem(last=False)
+            self.size -= len(evicted_data)
+
+    async def get_disk(self, key: tuple[str, int]) -> bytes | None:
+        if self.disk_path is None:
+            return None
+
+        disk_name = self.get_disk_name(key)
+        try:
+            data = await asyncio.to_thread((self.disk_path / disk_name).read_bytes)
+        except OSError:
+            return None
+
+        # The file may have been written by another process
+        self.add_disk_entry(disk_name, len(data))
+        return data
+
+    async def put_disk(self, key: tuple[str, int], data: bytes) -> None:
+        if self.disk_path is None or len(data) > self.disk_max_bytes:
+            return
+
+        disk_name = self.get_disk_name(key)
+        try:
+            await asyncio.to_thread(self.write_disk_file, disk_name, data)
+        except OSError:
+            logger.exception("Failed to write cover to disk")
+            return
+
+        self.add_disk_entry(disk_name, len(data))
+        self.evict_disk()
+
+    def write_disk_file(self, disk_name: str, data: bytes) -> None:
+        # Written to a temporary file first so other processes never read a
+        # partial cover
+        cover_path = self.disk_path / disk_name
+        temp_cover_path = cover_path.with_name(f"{disk_name}.{os.getpid()}.tmp")
+        try:
+            temp_cover_path.write_bytes(data)
+            os.replace(temp_cover_path, cover_path)
+        except OSError:
+            temp_cover_path.unlink(missing_ok=True)
+            raise
+
+    def add_disk_entry(self, disk_name: str, size: int) -> None:
+        self.disk_size += size - self.disk_entries.pop(disk_name, 0)
+        self.disk_entries[disk_name] = size
+
+    def evict_disk(self) -> None:
+        while self.disk_size > self.disk_max_bytes and self.disk_entries:
+            disk_name, size = self.disk_entries.popitem(last=False)
+            self.disk_size -= size
+            (self.disk_path / disk_name).unlink(missing_ok=True)
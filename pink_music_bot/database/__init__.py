@@ -1,4 +1,5 @@
 from .database import Database
+from .download_job import DownloadJob, DownloadJobDatabase
 from .music_video import MusicVideo, MusicVideoDatabase
 from .song import Song, SongDatabase
-from .user import User, UserDatabase
+from .user import User, UserCache, UserDatabase
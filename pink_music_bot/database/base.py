@@ -1,5 +1,8 @@
 from sqlalchemy.orm import DeclarativeBase
 
+# Keeps IN (...) lookups below SQLite's bound parameter limit
+MAX_IDS_PER_QUERY = 500
+
 
 class Base(DeclarativeBase):
     pass
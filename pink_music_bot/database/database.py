@@ -1,31 +1,46 @@
 from contextlib import asynccontextmanager
 from typing import AsyncGenerator
 
+from sqlalchemy import Connection, inspect, text
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
 from .base import Base
+from .download_job import DownloadJobDatabase
 from .music_video import MusicVideoDatabase
 from .song import SongDatabase
-from .user import UserDatabase
+from .user import UserCache, UserDatabase
 
 
 class Database:
     def __init__(
         self,
         database_url: str,
+        user_cache_size: int = 0,
+        user_cache_ttl: float = 0,
     ) -> None:
         self.database_url = database_url
+        self.user_cache_size = user_cache_size
+        self.user_cache_ttl = user_cache_ttl
 
     @classmethod
-    async def create(cls, database_url: str) -> None:
-        database = cls(database_url)
+    async def create(
+        cls,
+        database_url: str,
+        user_cache_size: int = 0,
+        user_cache_ttl: float = 0,
+    ) -> None:
+        database = cls(database_url, user_cache_size, user_cache_ttl)
         await database.initialize()
         return database
 
     async def initialize(self) -> None:
+        self.download_job = DownloadJobDatabase(self.get_session)
         self.music_video = MusicVideoDatabase(self.get_session)
         self.song = SongDatabase(self.get_session)
-        self.user = UserDatabase(self.get_session)
+        self.user = UserDatabase(
+            self.get_session,
+            UserCache(self.user_cache_size, self.user_cache_ttl),
+        )
 
         self.engine = create_async_engine(
             self.database_url,
@@ -45,6 +60,29 @@ class Database:
 
         async with self.engine.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(self.add_missing_columns)
+
+    @staticmethod
+    def add_missing_columns(conn: Connection) -> None:
+        # create_all only creates missing tables, so nullable columns added to
+        # existing tables are created here
+        inspector = inspect(conn)
+        preparer = conn.dialect.identifier_preparer
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {
+                column["name"] for column in inspector.get_columns(table.name)
+            }
+            for column in table.columns:
+                if column.name in existing_columns or not column.nullable:
+                    continue
+
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {preparer.format_table(table)} "
+                        f"ADD COLUMN {preparer.format_column(column)} "
+                        f"{column.type.compile(conn.dialect)}"
+                    )
+                )
 
     @asynccontextmanager
     async def get_session(self) -> AsyncGenerator[AsyncSession, None]:
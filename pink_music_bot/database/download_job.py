@@ -0,0 +1,216 @@
+import datetime
+from contextlib import AbstractAsyncContextManager
+from typing import Callable
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Integer,
+    String,
+    delete,
+    func,
+    select,
+    update,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from .base import MAX_IDS_PER_QUERY, Base
+
+# While the URL of a batch is still being expanded, the batch has one job
+# without a media ID at the position where the expansion continues
+EXPANSION_MEDIA_ID = ""
+
+
+class DownloadJob(Base):
+    __tablename__ = "download_job"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # Items expanded from the same URL of the same message share a batch
+    batch_id = Column(String(32), nullable=False, index=True)
+    user_id = Column(BigInteger, nullable=False, index=True)
+    chat_id = Column(BigInteger, nullable=False)
+    message_id = Column(Integer, nullable=False)
+    url = Column(String(1024), nullable=False)
+    media_id = Column(String(64), nullable=False)
+    position = Column(Integer, nullable=False)
+    # Lower priorities are claimed first, like in the priority semaphores
+    priority = Column(Integer, nullable=True, default=None)
+    # Unclaimed jobs have no worker, delivered jobs are deleted
+    worker_id = Column(String(64), nullable=True, default=None, index=True)
+    claimed_at = Column(DateTime, nullable=True, default=None)
+    # Set while the job holds a credit reserved from its user, the credit is
+    # spent when the job is delivered and refunded otherwise
+    credits_reserved_at = Column(DateTime, nullable=True, default=None)
+
+    @property
+    def is_expansion(self) -> bool:
+        return self.media_id == EXPANSION_MEDIA_ID
+
+
+class DownloadJobDatabase:
+    def __init__(
+        self,
+        get_session: Callable[[], AbstractAsyncContextManager[AsyncSession]],
+    ):
+        self.get_session = get_session
+
+    async def add_batch(
+        self,
+        batch_id: str,
+        user_id: int,
+        chat_id: int,
+        message_id: int,
+        url: str,
+        media_ids: list[str],
+        first_position: int = 0,
+        worker_id: str | None = None,
+        priority: int | None = None,
+        expanded: bool = True,
+    ) -> list[int]:
+        # Items appended to a batch that is already being processed are
+        # stored as claimed by its worker, so no other worker picks them up.
+        # Unless the URL has no items after these, the expansion job moves
+        # behind them.
+        claimed_at = datetime.datetime.now() if worker_id is not None else None
+        download_jobs = [
+            DownloadJob(
+                batch_id=batch_id,
+                user_id=user_id,
+                chat_id=chat_id,
+                message_id=message_id,
+                url=url,
+                media_id=media_id,
+                position=position,
+                priority=priority,
+                worker_id=worker_id,
+                claimed_at=claimed_at,
+            )
+            for position, media_id in enumerate(
+                media_ids if expanded else [*media_ids, EXPANSION_MEDIA_ID],
+                first_position,
+            )
+        ]
+        async with self.get_session() as session:
+            await session.execute(
+                delete(DownloadJob).where(
+                    DownloadJob.batch_id == batch_id,
+                    DownloadJob.media_id == EXPANSION_MEDIA_ID,
+                )
+            )
+            session.add_all(download_jobs)
+            await session.flush()
+            return [download_job.id for download_job in download_jobs[: len(media_ids)]]
+
+    async def finish_expansion(self, batch_id: str) -> None:
+        async with self.get_session() as session:
+            await session.execute(
+                delete(DownloadJob).where(
+                    DownloadJob.batch_id == batch_id,
+                    DownloadJob.media_id == EXPANSION_MEDIA_ID,
+                )
+            )
+
+    async def claim_batch(self, worker_id: str) -> list[DownloadJob]:
+        async with self.get_session() as session:
+            # Batches are claimed by priority, then users without a batch in
+            # progress go first so one user's playlists don't hold every
+            # worker. Workers skip batches another worker is claiming, and
+            # the conditional update below makes sure only one of them wins
+            # on databases without row locks
+            claimed_download_job = aliased(DownloadJob)
+            result = await session.execute(
+                select(DownloadJob.batch_id)
+                .where(DownloadJob.worker_id.is_(None))
+                .order_by(
+                    func.coalesce(DownloadJob.priority, 1),
+                    DownloadJob.user_id.in_(
+                        select(claimed_download_job.user_id).where(
+                            claimed_download_job.worker_id.is_not(None)
+                        )
+                    ),
+                    DownloadJob.id,
+                )
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            )
+            batch_id = result.scalar_one_or_none()
+            if batch_id is None:
+                return []
+
+            result = await session.execute(
+                update(DownloadJob)
+                .where(
+                    DownloadJob.batch_id == batch_id,
+                    DownloadJob.worker_id.is_(None),
+                )
+                .values(worker_id=worker_id, claimed_at=datetime.datetime.now())
+            )
+            if result.rowcount == 0:
+                return []
+
+            result = await session.execute(
+                select(DownloadJob)
+                .where(
+                    DownloadJob.batch_id == batch_id,
+                    DownloadJob.worker_id == worker_id,
+                )
+                .order_by(DownloadJob.position)
+            )
+            return list(result.scalars())
+
+    async def renew(self, worker_prefix: str) -> None:
+        async with self.get_session() as session:
+            await session.execute(
+                update(DownloadJob)
+                .where(DownloadJob.worker_id.startswith(worker_prefix))
+                .values(claimed_at=datetime.datetime.now())
+            )
+
+    async def release(self, worker_prefix: str) -> int:
+        async with self.get_session() as session:
+            result = await session.execute(
+                update(DownloadJob)
+                .where(DownloadJob.worker_id.startswith(worker_prefix))
+                .values(worker_id=None, claimed_at=None)
+            )
+            return result.rowcount
+
+    async def release_expired(self, claimed_before: datetime.datetime) -> int:
+        async with self.get_session() as session:
+            result = await session.execute(
+                update(DownloadJob)
+                .where(DownloadJob.claimed_at < claimed_before)
+                .values(worker_id=None, claimed_at=None)
+            )
+            return result.rowcount
+
+    async def has_user_jobs(self, user_id: int) -> bool:
+        async with self.get_session() as session:
+            result = await session.execute(
+                select(DownloadJob.id).where(DownloadJob.user_id == user_id).limit(1)
+            )
+            return result.scalar_one_or_none() is not None
+
+    async def delete(self, download_job_ids: list[int]) -> None:
+        async with self.get_session() as session:
+            for i in range(0, len(download_job_ids), MAX_IDS_PER_QUERY):
+                await session.execute(
+                    delete(DownloadJob).where(
+                        DownloadJob.id.in_(download_job_ids[i : i + MAX_IDS_PER_QUERY])
+                    )
+                )
+
+    async def delete_batch(self, batch_id: str) -> None:
+        async with self.get_session() as session:
+            await session.execute(
+                delete(DownloadJob).where(DownloadJob.batch_id == batch_id)
+            )
+
+    async def count(self) -> int:
+        async with self.get_session() as session:
+            result = await session.execute(
+                select(func.count()).select_from(DownloadJob)
+            )
+            return result.scalar_one()
@@ -1,10 +1,21 @@
 from contextlib import AbstractAsyncContextManager
 from typing import Callable
 
-from sqlalchemy import Boolean, Column, Integer, String, delete, func, select
+from sqlalchemy import (
+    Boolean,
+    Column,
+    Integer,
+    String,
+    bindparam,
+    delete,
+    func,
+    select,
+    tuple_,
+    update,
+)
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from .base import Base
+from .base import MAX_IDS_PER_QUERY, Base
 
 
 class MusicVideo(Base):
@@ -14,6 +25,8 @@ class MusicVideo(Base):
     fourk = Column(Boolean, primary_key=True)
     too_large = Column(Boolean, default=False, nullable=False)
     message_id = Column(Integer, nullable=True)
+    file_id = Column(String(255), nullable=True, default=None)
+    file_unique_id = Column(String(64), nullable=True, default=None)
 
 
 class MusicVideoDatabase:
@@ -29,6 +42,8 @@ class MusicVideoDatabase:
         fourk: bool,
         message_id: int,
         too_large: bool = False,
+        file_id: str | None = None,
+        file_unique_id: str | None = None,
     ) -> MusicVideo:
         async with self.get_session() as session:
             music_video = MusicVideo(
@@ -36,6 +51,8 @@ class MusicVideoDatabase:
                 fourk=fourk,
                 message_id=message_id,
                 too_large=too_large,
+                file_id=file_id,
+                file_unique_id=file_unique_id,
             )
             merged_music_video = await session.merge(music_video)
             return merged_music_video
@@ -53,6 +70,56 @@ class MusicVideoDatabase:
             )
             return result.scalar_one_or_none()
 
+    async def get_many(
+        self,
+        music_video_ids: list[str],
+        fourk: bool,
+    ) -> dict[str, MusicVideo]:
+        music_videos = {}
+        async with self.get_session() as session:
+            for i in range(0, len(music_video_ids), MAX_IDS_PER_QUERY):
+                result = await session.execute(
+                    select(MusicVideo).where(
+                        MusicVideo.id.in_(music_video_ids[i : i + MAX_IDS_PER_QUERY]),
+                        MusicVideo.fourk == fourk,
+                    )
+                )
+                music_videos.update(
+                    (music_video.id, music_video) for music_video in result.scalars()
+                )
+        return music_videos
+
+    async def get_many_without_file_id(
+        self,
+        limit: int,
+        after: tuple[str, bool] | None = None,
+    ) -> list[MusicVideo]:
+        async with self.get_session() as session:
+            query = select(MusicVideo).where(
+                MusicVideo.file_id.is_(None),
+                MusicVideo.message_id.is_not(None),
+            )
+            if after is not None:
+                query = query.where(tuple_(MusicVideo.id, MusicVideo.fourk) > after)
+            result = await session.execute(
+                query.order_by(MusicVideo.id, MusicVideo.fourk).limit(limit)
+            )
+            return list(result.scalars())
+
+    async def update_file_ids(self, music_videos: list[dict]) -> None:
+        # Rows are only updated while they point to the message the file IDs
+        # were read from, a music video uploaded again in the meantime keeps
+        # its new message
+        async with self.get_session() as session:
+            await session.execute(
+                update(MusicVideo.__table__).where(
+                    MusicVideo.__table__.c.id == bindparam("music_video_id"),
+                    MusicVideo.__table__.c.fourk == bindparam("music_video_fourk"),
+                    MusicVideo.__table__.c.message_id == bindparam("read_message_id"),
+                ),
+                music_videos,
+            )
+
     async def delete(self, music_video_id: str, fourk: bool) -> bool:
         async with self.get_session() as session:
             result = await session.execute(
@@ -62,6 +129,23 @@ class MusicVideoDatabase:
             )
             return result.rowcount > 0
 
+    async def delete_many(self, music_videos: list[tuple[str, bool, int]]) -> None:
+        # Like update_file_ids, rows pointing to another message than the
+        # given one were uploaded again and are kept
+        async with self.get_session() as session:
+            for i in range(0, len(music_videos), MAX_IDS_PER_QUERY):
+                await session.execute(
+                    delete(MusicVideo).where(
+                        tuple_(
+                            MusicVideo.id,
+                            MusicVideo.fourk,
+                            MusicVideo.message_id,
+                        ).in_(
+                            music_videos[i : i + MAX_IDS_PER_QUERY]
+                        )
+                    )
+                )
+
     async def count(self) -> int:
         async with self.get_session() as session:
             result = await session.execute(select(func.count()).select_from(MusicVideo))
@@ -2,10 +2,22 @@ from contextlib import AbstractAsyncContextManager
 from typing import Callable
 
 from gamdl.interface import SongCodec
-from sqlalchemy import Column, Enum, Integer, String, delete, func, select
+from sqlalchemy import (
+    Column,
+    Enum,
+    Integer,
+    String,
+    bindparam,
+    cast,
+    delete,
+    func,
+    select,
+    tuple_,
+    update,
+)
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from .base import Base
+from .base import MAX_IDS_PER_QUERY, Base
 
 
 class Song(Base):
@@ -15,6 +27,10 @@ class Song(Base):
     codec = Column(Enum(SongCodec), nullable=False, primary_key=True)
     message_id_song = Column(Integer, nullable=False)
     message_id_synced_lyrics = Column(Integer, nullable=True, default=None)
+    file_id_song = Column(String(255), nullable=True, default=None)
+    file_unique_id_song = Column(String(64), nullable=True, default=None)
+    file_id_synced_lyrics = Column(String(255), nullable=True, default=None)
+    file_unique_id_synced_lyrics = Column(String(64), nullable=True, default=None)
 
 
 class SongDatabase:
@@ -34,12 +50,33 @@ class SongDatabase:
             )
             return result.scalar_one_or_none()
 
+    async def get_many(
+        self,
+        song_ids: list[str],
+        codec: SongCodec,
+    ) -> dict[str, Song]:
+        songs = {}
+        async with self.get_session() as session:
+            for i in range(0, len(song_ids), MAX_IDS_PER_QUERY):
+                result = await session.execute(
+                    select(Song).where(
+                        Song.id.in_(song_ids[i : i + MAX_IDS_PER_QUERY]),
+                        Song.codec == codec,
+                    )
+                )
+                songs.update((song.id, song) for song in result.scalars())
+        return songs
+
     async def add_if_not_exists(
         self,
         song_id: str,
         codec: SongCodec,
         message_id_song: int,
         message_id_synced_lyrics: int | None = None,
+        file_id_song: str | None = None,
+        file_unique_id_song: str | None = None,
+        file_id_synced_lyrics: str | None = None,
+        file_unique_id_synced_lyrics: str | None = None,
     ) -> Song:
         async with self.get_session() as session:
             song = Song(
@@ -47,10 +84,47 @@ class SongDatabase:
                 codec=codec,
                 message_id_song=message_id_song,
                 message_id_synced_lyrics=message_id_synced_lyrics,
+                file_id_song=file_id_song,
+                file_unique_id_song=file_unique_id_song,
+                file_id_synced_lyrics=file_id_synced_lyrics,
+                file_unique_id_synced_lyrics=file_unique_id_synced_lyrics,
             )
             merged_song = await session.merge(song)
             return merged_song
 
+    async def get_many_without_file_id(
+        self,
+        limit: int,
+        after: tuple[str, SongCodec] | None = None,
+    ) -> list[Song]:
+        # Enum columns don't compare by name everywhere (MySQL compares ENUM
+        # values by their index), so the keyset pages on the codec as a string
+        codec = cast(Song.codec, String)
+        async with self.get_session() as session:
+            query = select(Song).where(Song.file_id_song.is_(None))
+            if after is not None:
+                after_id, after_codec = after
+                query = query.where(
+                    tuple_(Song.id, codec) > (after_id, after_codec.name)
+                )
+            result = await session.execute(query.order_by(Song.id, codec).limit(limit))
+            return list(result.scalars())
+
+    async def update_file_ids(self, songs: list[dict]) -> None:
+        # Rows are only updated while they point to the message the file IDs
+        # were read from, a song uploaded again in the meantime keeps its new
+        # message
+        async with self.get_session() as session:
+            await session.execute(
+                update(Song.__table__).where(
+                    Song.__table__.c.id == bindparam("song_id"),
+                    Song.__table__.c.codec == bindparam("song_codec"),
+                    Song.__table__.c.message_id_song
+                    == bindparam("read_message_id_song"),
+                ),
+                songs,
+            )
+
     async def delete(self, song_id: str, codec: SongCodec) -> bool:
         async with self.get_session() as session:
             result = await session.execute(
@@ -58,6 +132,19 @@ class SongDatabase:
             )
             return result.rowcount > 0
 
+    async def delete_many(self, songs: list[tuple[str, SongCodec, int]]) -> None:
+        # Like update_file_ids, rows pointing to another message than the
+        # given one were uploaded again and are kept
+        async with self.get_session() as session:
+            for i in range(0, len(songs), MAX_IDS_PER_QUERY):
+                await session.execute(
+                    delete(Song).where(
+                        tuple_(Song.id, Song.codec, Song.message_id_song).in_(
+                            songs[i : i + MAX_IDS_PER_QUERY]
+                        )
+                    )
+                )
+
     async def count(self) -> int:
         async with self.get_session() as session:
             result = await session.execute(select(func.count()).select_from(Song))
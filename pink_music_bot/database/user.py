@@ -1,5 +1,9 @@
+import asyncio
 import datetime
+import time
+from collections import OrderedDict
 from contextlib import AbstractAsyncContextManager
+from dataclasses import dataclass
 from typing import Callable
 
 from gamdl.interface import SongCodec
@@ -7,18 +11,26 @@ from sqlalchemy import (
     BigInteger,
     Boolean,
     Column,
+    ColumnElement,
     DateTime,
     Enum,
     Integer,
     String,
+    bindparam,
+    case,
     delete,
     func,
+    insert,
+    or_,
     select,
     update,
 )
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from .base import Base
+from .base import MAX_IDS_PER_QUERY, Base
+from .download_job import DownloadJob
+
+FREE_CREDITS_INTERVAL = datetime.timedelta(days=1)
 
 
 class User(Base):
@@ -48,28 +60,260 @@ class User(Base):
         return self.membership_due_date > datetime.datetime.now()
 
 
+class UserCache:
+    # Recently used users keyed on id. Callers get a detached copy, since
+    # handlers modify the user they work with (e.g. reserved credits). Every
+    # write through UserDatabase invalidates the entry, so the cache is only
+    # enabled when a single process runs the whole bot.
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[int, tuple[float, User]] = OrderedDict()
+        # Reads that started before an invalidation must not be cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    @staticmethod
+    def copy(user: User) -> User:
+        return User(
+            **{
+                column.name: getattr(user, column.name)
+                for column in User.__table__.columns
+            }
+        )
+
+    def get(self, user_id: int) -> User | None:
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] <= time.monotonic():
+            self.entries.pop(user_id, None)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        return self.copy(entry[1])
+
+    def put(self, user: User, generation: int) -> None:
+        if not self.max_entries or generation != self.generation:
+            return
+
+        self.entries[user.id] = (time.monotonic() + self.ttl, self.copy(user))
+        self.entries.move_to_end(user.id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        self.generation += 1
+        self.entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self.entries.clear()
+
+
+@dataclass
+class UserCounters:
+    songs_downloaded: int = 0
+    music_videos_downloaded: int = 0
+
+    def add(self, other: "UserCounters") -> None:
+        self.songs_downloaded += other.songs_downloaded
+        self.music_videos_downloaded += other.music_videos_downloaded
+
+
 class UserDatabase:
     def __init__(
         self,
         get_session: Callable[[], AbstractAsyncContextManager[AsyncSession]],
+        cache: UserCache,
     ):
         self.get_session = get_session
+        self.cache = cache
+        # Download counters are written in bulk by flush_counters, users
+        # handed out by get and load include the deltas not flushed yet
+        self.pending_counters: dict[int, UserCounters] = {}
+        self.flushing_counters: dict[int, UserCounters] = {}
+        self.counter_flush: asyncio.Future[None] | None = None
+        self.counter_flushes = 0
+
+    def apply_counters(self, user: User) -> User:
+        for counters in (
+            self.pending_counters.get(user.id),
+            self.flushing_counters.get(user.id),
+        ):
+            if counters is not None:
+                user.songs_downloaded += counters.songs_downloaded
+                user.music_videos_downloaded += counters.music_videos_downloaded
+
+        return user
+
+    async def wait_for_counter_flush(self) -> int:
+        # A row read while a flush commits may or may not include its deltas,
+        # so reads wait for it and are retried if another flush started
+        while self.counter_flush is not None:
+            await asyncio.shield(self.counter_flush)
+
+        return self.counter_flushes
 
     async def get(self, user_id: int) -> User | None:
-        async with self.get_session() as session:
-            result = await session.execute(select(User).where(User.id == user_id))
-            return result.scalar_one_or_none()
+        user = self.cache.get(user_id)
+        if user is not None:
+            return self.apply_counters(user)
+
+        while True:
+            counter_flushes = await self.wait_for_counter_flush()
+            generation = self.cache.generation
+            async with self.get_session() as session:
+                result = await session.execute(select(User).where(User.id == user_id))
+                user = result.scalar_one_or_none()
+
+            if counter_flushes == self.counter_flushes:
+                break
+
+        if user is None:
+            return None
+
+        self.cache.put(user, generation)
+        return self.apply_counters(user)
 
     async def get_by_email(self, email: str) -> User | None:
         async with self.get_session() as session:
             result = await session.execute(select(User).where(User.email == email))
             return result.scalar_one_or_none()
 
-    async def add_if_not_exists(self, user_id: int) -> User:
+    async def load(
+        self,
+        user_id: int,
+        free_daily_credits: int,
+        create: bool = True,
+    ) -> User | None:
+        # Creates the user if needed and applies the daily free credits in a
+        # single transaction. A cached user costs nothing, or only the refresh
+        # once a day, an uncached one a single SELECT.
+        now = datetime.datetime.now()
+        cached_user = self.cache.get(user_id)
+        if cached_user is not None and not self.free_credits_due(cached_user, now):
+            return self.apply_counters(cached_user)
+
+        while True:
+            counter_flushes = await self.wait_for_counter_flush()
+            generation = self.cache.generation
+            async with self.get_session() as session:
+                user = None
+                if cached_user is not None:
+                    user = await self.refresh_free_credits(
+                        session,
+                        user_id,
+                        free_daily_credits,
+                        now,
+                    )
+                if user is None:
+                    result = await session.execute(
+                        select(User).where(User.id == user_id)
+                    )
+                    user = result.scalar_one_or_none()
+                if user is None:
+                    if not create:
+                        return None
+
+                    # Concurrent updates of a new user may insert it at once
+                    await session.execute(
+                        insert(User)
+                        .values(id=user_id)
+                        .prefix_with("OR IGNORE", dialect="sqlite")
+                        .prefix_with("IGNORE", dialect="mysql")
+                    )
+                    result = await session.execute(
+                        select(User).where(User.id == user_id)
+                    )
+                    user = result.scalar_one()
+
+                if self.free_credits_due(user, now):
+                    refreshed_user = await self.refresh_free_credits(
+                        session,
+                        user_id,
+                        free_daily_credits,
+                        now,
+                    )
+                    if refreshed_user is None:
+                        # Refreshed by another process since the SELECT
+                        await session.refresh(user)
+                    else:
+                        user = refreshed_user
+
+            if counter_flushes == self.counter_flushes:
+                break
+
+        self.cache.put(user, generation)
+        return self.apply_counters(user)
+
+    @staticmethod
+    def free_credits_due(user: User, now: datetime.datetime) -> bool:
+        return (
+            user.last_free_credits_claim is None
+            or user.last_free_credits_claim <= now - FREE_CREDITS_INTERVAL
+        )
+
+    @staticmethod
+    def free_credits_due_clause(now: datetime.datetime) -> ColumnElement[bool]:
+        return or_(
+            User.last_free_credits_claim.is_(None),
+            User.last_free_credits_claim <= now - FREE_CREDITS_INTERVAL,
+        )
+
+    async def refresh_free_credits(
+        self,
+        session: AsyncSession,
+        user_id: int,
+        free_daily_credits: int,
+        now: datetime.datetime,
+    ) -> User | None:
+        # The claim is checked by the UPDATE itself, so concurrent refreshes
+        # of the same user only apply once. Returns None if no refresh was
+        # due or the user does not exist.
+        statement = (
+            update(User)
+            .where(User.id == user_id)
+            .where(self.free_credits_due_clause(now))
+            .values(credits=free_daily_credits, last_free_credits_claim=now)
+            .execution_options(synchronize_session=False)
+        )
+        if session.bind.dialect.update_returning:
+            result = await session.execute(
+                statement.returning(User),
+                execution_options={"populate_existing": True},
+            )
+            return result.scalar_one_or_none()
+
+        result = await session.execute(statement)
+        if not result.rowcount:
+            return None
+
+        result = await session.execute(
+            select(User)
+            .where(User.id == user_id)
+            .execution_options(populate_existing=True)
+        )
+        return result.scalar_one()
+
+    async def refresh_all_free_credits(self, free_daily_credits: int) -> int:
+        now = datetime.datetime.now()
         async with self.get_session() as session:
-            user = User(id=user_id)
-            merged_user = await session.merge(user)
-            return merged_user
+            result = await session.execute(
+                update(User)
+                .where(self.free_credits_due_clause(now))
+                .values(credits=free_daily_credits, last_free_credits_claim=now)
+                .execution_options(synchronize_session=False)
+            )
+
+        self.cache.clear()
+        return result.rowcount
 
     async def toggle_fourk_download(self, user_id: int) -> bool | None:
         async with self.get_session() as session:
@@ -84,7 +328,9 @@ class UserDatabase:
             await session.execute(
                 update(User).where(User.id == user_id).values(fourk_download=new_value)
             )
-            return new_value
+
+        self.cache.invalidate(user_id)
+        return new_value
 
     async def toggle_synced_lyrics_file_upload(
         self,
@@ -104,7 +350,9 @@ class UserDatabase:
                 .where(User.id == user_id)
                 .values(synced_lyrics_file_upload=new_value)
             )
-            return new_value
+
+        self.cache.invalidate(user_id)
+        return new_value
 
     async def update_song_codec(self, user_id: int, codec: SongCodec) -> None:
         async with self.get_session() as session:
@@ -112,6 +360,8 @@ class UserDatabase:
                 update(User).where(User.id == user_id).values(song_codec=codec)
             )
 
+        self.cache.invalidate(user_id)
+
     async def update_search_country(self, user_id: int, country_code: str) -> None:
         async with self.get_session() as session:
             await session.execute(
@@ -120,57 +370,198 @@ class UserDatabase:
                 .values(search_country=country_code)
             )
 
+        self.cache.invalidate(user_id)
+
     async def delete(self, user_id: int) -> bool:
         async with self.get_session() as session:
             result = await session.execute(delete(User).where(User.id == user_id))
-            return result.rowcount > 0
+
+        self.pending_counters.pop(user_id, None)
+        self.cache.invalidate(user_id)
+        return result.rowcount > 0
 
     async def count(self) -> int:
         async with self.get_session() as session:
             result = await session.execute(select(func.count()).select_from(User))
             return result.scalar_one()
 
-    async def increment_songs_downloaded(self, user_id: int) -> None:
-        async with self.get_session() as session:
-            await session.execute(
-                update(User)
-                .where(User.id == user_id)
-                .values(songs_downloaded=User.songs_downloaded + 1)
-            )
-
-    async def increment_music_videos_downloaded(self, user_id: int) -> None:
-        async with self.get_session() as session:
-            await session.execute(
-                update(User)
-                .where(User.id == user_id)
-                .values(music_videos_downloaded=User.music_videos_downloaded + 1)
-            )
-
-    async def set_credits(self, user_id: int, credits: int) -> None:
-        async with self.get_session() as session:
-            await session.execute(
-                update(User).where(User.id == user_id).values(credits=credits)
-            )
-
-    async def update_last_free_credits_claim(
+    def add_counters(
         self,
         user_id: int,
-        claim_time: datetime.datetime,
+        songs_downloaded: int = 0,
+        music_videos_downloaded: int = 0,
     ) -> None:
+        if not (songs_downloaded or music_videos_downloaded):
+            return
+
+        self.pending_counters.setdefault(user_id, UserCounters()).add(
+            UserCounters(songs_downloaded, music_videos_downloaded)
+        )
+
+    async def flush_counters(self) -> None:
+        while self.counter_flush is not None:
+            await asyncio.shield(self.counter_flush)
+
+        counters, self.pending_counters = self.pending_counters, {}
+        if not counters:
+            return
+
+        self.flushing_counters = counters
+        self.counter_flush = asyncio.get_running_loop().create_future()
+        self.counter_flushes += 1
+        try:
+            async with self.get_session() as session:
+                await session.execute(
+                    update(User.__table__)
+                    .where(User.__table__.c.id == bindparam("user_id"))
+                    .values(
+                        songs_downloaded=User.__table__.c.songs_downloaded
+                        + bindparam("songs_downloaded_delta"),
+                        music_videos_downloaded=(
+                            User.__table__.c.music_videos_downloaded
+                            + bindparam("music_videos_downloaded_delta")
+                        ),
+                    ),
+                    [
+                        {
+                            "user_id": counter_user_id,
+                            "songs_downloaded_delta": user_counters.songs_downloaded,
+                            "music_videos_downloaded_delta": (
+                                user_counters.music_videos_downloaded
+                            ),
+                        }
+                        for counter_user_id, user_counters in counters.items()
+                    ],
+                )
+        except BaseException:
+            # Kept for the next flush, including when cancelled at shutdown
+            for counter_user_id, user_counters in counters.items():
+                self.pending_counters.setdefault(
+                    counter_user_id,
+                    UserCounters(),
+                ).add(user_counters)
+            raise
+        else:
+            for counter_user_id in counters:
+                self.cache.invalidate(counter_user_id)
+        finally:
+            self.flushing_counters = {}
+            self.counter_flush.set_result(None)
+            self.counter_flush = None
+
+    async def reserve_credits(
+        self,
+        user_id: int,
+        download_job_ids: list[int],
+    ) -> int | None:
+        # Reserves one credit per job and returns the remaining credits, or
+        # None if the user has less than that. Concurrent downloads cannot
+        # overspend since the check and the deduction are a single statement,
+        # and the jobs are marked in the same transaction so the credits of a
+        # batch that crashes are still known when it resumes.
+        now = datetime.datetime.now()
+        statement = (
+            update(User)
+            .where(User.id == user_id)
+            .where(User.credits >= len(download_job_ids))
+            .values(credits=User.credits - len(download_job_ids))
+        )
         async with self.get_session() as session:
-            await session.execute(
-                update(User)
-                .where(User.id == user_id)
-                .values(last_free_credits_claim=claim_time)
-            )
-
-    async def deduct_credits(self, user_id: int, credits: int) -> None:
+            if session.bind.dialect.update_returning:
+                result = await session.execute(statement.returning(User.credits))
+                remaining_credits = result.scalar_one_or_none()
+            else:
+                result = await session.execute(statement)
+                remaining_credits = None
+                if result.rowcount:
+                    result = await session.execute(
+                        select(User.credits).where(User.id == user_id)
+                    )
+                    remaining_credits = result.scalar_one()
+
+            if remaining_credits is not None:
+                for i in range(0, len(download_job_ids), MAX_IDS_PER_QUERY):
+                    await session.execute(
+                        update(DownloadJob)
+                        .where(
+                            DownloadJob.id.in_(
+                                download_job_ids[i : i + MAX_IDS_PER_QUERY]
+                            )
+                        )
+                        .values(credits_reserved_at=now)
+                    )
+
+        self.cache.invalidate(user_id)
+        return remaining_credits
+
+    async def refund_credits(
+        self,
+        user_id: int,
+        download_job_ids: list[int],
+        free_daily_credits: int,
+    ) -> int | None:
+        # Refunds the credits the jobs still hold and returns the user's
+        # credits. Credits reserved before a daily refresh only refill the
+        # refreshed balance up to the daily amount.
         async with self.get_session() as session:
-            await session.execute(
-                update(User)
-                .where(User.id == user_id)
-                .values(credits=User.credits - credits)
+            reservations = {}
+            for i in range(0, len(download_job_ids), MAX_IDS_PER_QUERY):
+                result = await session.execute(
+                    select(DownloadJob.id, DownloadJob.credits_reserved_at)
+                    .where(
+                        DownloadJob.id.in_(download_job_ids[i : i + MAX_IDS_PER_QUERY]),
+                        DownloadJob.credits_reserved_at.is_not(None),
+                    )
+                    .with_for_update()
+                )
+                for download_job_id, credits_reserved_at in result:
+                    reservations.setdefault(credits_reserved_at, []).append(
+                        download_job_id
+                    )
+
+            # Only jobs whose mark is cleared here are refunded, so a job is
+            # never refunded twice. Newer reservations go first so the cap
+            # applies to the refreshed balance including them.
+            for credits_reserved_at, reserved_job_ids in sorted(
+                reservations.items(),
+                reverse=True,
+            ):
+                result = await session.execute(
+                    update(DownloadJob)
+                    .where(
+                        DownloadJob.id.in_(reserved_job_ids),
+                        DownloadJob.credits_reserved_at.is_not(None),
+                    )
+                    .values(credits_reserved_at=None)
+                )
+                refunded_credits = User.credits + result.rowcount
+                await session.execute(
+                    update(User)
+                    .where(User.id == user_id)
+                    .values(
+                        credits=case(
+                            (
+                                or_(
+                                    User.last_free_credits_claim.is_(None),
+                                    User.last_free_credits_claim
+                                    <= credits_reserved_at,
+                                ),
+                                refunded_credits,
+                            ),
+                            (refunded_credits <= free_daily_credits, refunded_credits),
+                            (User.credits < free_daily_credits, free_daily_credits),
+                            else_=User.credits,
+                        )
+                    )
+                )
+
+            result = await session.execute(
+                select(User.credits).where(User.id == user_id)
             )
+            credits = result.scalar_one_or_none()
+
+        self.cache.invalidate(user_id)
+        return credits
 
     async def add_membership_days(
         self,
@@ -207,7 +598,12 @@ class UserDatabase:
                     update(User).where(User.id == user_id).values(email=email)
                 )
 
-            return new_due_date
+        if email is not None:
+            # The email may have been taken from another cached user
+            self.cache.clear()
+        else:
+            self.cache.invalidate(user_id)
+        return new_due_date
 
     async def count_members(self) -> int:
         async with self.get_session() as session:
@@ -223,3 +619,5 @@ class UserDatabase:
             await session.execute(
                 update(User).where(User.id == user_id).values(membership_due_date=None)
             )
+
+        self.cache.invalidate(user_id)
@@ -0,0 +1,50 @@
+import asyncio
+import shutil
+
+RECHECK_INTERVAL = 5
+
+
+class DiskAdmission:
+    # Downloads reserve their estimated temp size before they start and keep
+    # it until their temp files are cleaned up. A download waits while its
+    # reservation would exceed the budget or the free space of the volume;
+    # free space already includes what in-flight downloads have written, so
+    # the check errs on the side of waiting.
+    def __init__(
+        self,
+        path: str,
+        budget: int = 0,
+        min_free_space: int = 0,
+    ):
+        self.path = path
+        self.budget = budget
+        self.min_free_space = min_free_space
+        self.reserved = 0
+        self.released = asyncio.Event()
+
+    def can_admit(self, size: int) -> bool:
+        # A single download is always admitted, otherwise an item larger than
+        # the budget would wait forever
+        if not self.reserved:
+            return True
+
+        if self.budget and self.reserved + size > self.budget:
+            return False
+
+        free_space = shutil.disk_usage(self.path).free
+        return self.reserved + size <= free_space - self.min_free_space
+
+    async def acquire(self, size: int) -> None:
+        while not self.can_admit(size):
+            self.released.clear()
+            try:
+                # Free space can also change outside of the bot
+                await asyncio.wait_for(self.released.wait(), RECHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+        self.reserved += size
+
+    def release(self, size: int) -> None:
+        self.reserved -= size
+        self.released.set()
@@ -0,0 +1,19 @@
+import asyncio
+
+
+class DownloadJobQueue:
+    # Download jobs are persisted in the database, this wakes up the workers
+    # of this process when new ones are stored instead of waiting for the
+    # next poll
+    def __init__(self):
+        self.event = asyncio.Event()
+
+    def notify(self) -> None:
+        self.event.set()
+
+    async def wait(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
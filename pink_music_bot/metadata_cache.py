@@ -0,0 +1,115 @@
+import asyncio
+import copy
+import functools
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+from gamdl.api import AppleMusicApi
+
+# Catalog lookups used while building download queues. Playback and license
+# responses contain short lived URLs and keys, so they are never cached.
+CACHED_API_METHODS = (
+    "get_song",
+    "get_music_video",
+    "get_album",
+    "get_playlist",
+)
+
+
+class MetadataCache:
+    # Apple Music catalog responses keyed on storefront, method and media id,
+    # evicted after a TTL or when the cache holds too many entries. Callers
+    # get their own copy, since the downloader may modify the metadata.
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.fetches: dict[Hashable, asyncio.Future[None]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        requests = self.hits + self.misses
+        return self.hits / requests if requests else 0.0
+
+    def wrap(self, apple_music_api: AppleMusicApi) -> None:
+        if not self.ttl or not self.max_entries:
+            return
+
+        for method_name in CACHED_API_METHODS:
+            method = getattr(apple_music_api, method_name, None)
+            if method is not None:
+                setattr(
+                    apple_music_api,
+                    method_name,
+                    self.wrap_method(apple_music_api, method_name, method),
+                )
+
+    def wrap_method(
+        self,
+        apple_music_api: AppleMusicApi,
+        method_name: str,
+        method: Callable[..., Awaitable[Any]],
+    ) -> Callable[..., Awaitable[Any]]:
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            key = (
+                apple_music_api.storefront.lower(),
+                method_name,
+                args,
+                tuple(sorted(kwargs.items())),
+            )
+            try:
+                hash(key)
+            except TypeError:
+                return await method(*args, **kwargs)
+
+            return await self.get(key, lambda: method(*args, **kwargs))
+
+        return wrapper
+
+    def get_entry(self, key: Hashable) -> Any | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+        return value
+
+    async def get(
+        self,
+        key: Hashable,
+        fetch: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        # A hot URL requested by several users at once is only fetched once
+        while (fetch_future := self.fetches.get(key)) is not None:
+            await asyncio.shield(fetch_future)
+
+        value = self.get_entry(key)
+        if value is not None:
+            self.hits += 1
+            return copy.deepcopy(value)
+
+        self.misses += 1
+        self.fetches[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await fetch()
+            if value is not None:
+                self.put(key, copy.deepcopy(value))
+        finally:
+            self.fetches.pop(key).set_result(None)
+
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
@@ -1,63 +1,180 @@
 import asyncio
-from dataclasses import dataclass, field
-from typing import Any
+import heapq
+import time
+from collections import deque
 from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Hashable
 
 
 @dataclass(order=True)
 class PriorityItem:
     priority: int
     sequence: int  # Insertion order for FIFO within same priority
-    event: asyncio.Event = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+@dataclass
+class FairItem:
+    key: Hashable
+    enqueued: float
+    future: asyncio.Future
+
+
+class FairQueue:
+    # Deficit round robin over keys with unit cost per item, FIFO within a key
+    def __init__(self):
+        self.queues: dict[Hashable, deque[FairItem]] = {}
+        self.weights: dict[Hashable, int] = {}
+        self.deficits: dict[Hashable, int] = {}
+        self.active: deque[Hashable] = deque()
+
+    def __bool__(self) -> bool:
+        return bool(self.active)
+
+    def put(self, item: FairItem, weight: int) -> None:
+        if item.key not in self.queues:
+            self.queues[item.key] = deque()
+            self.deficits[item.key] = 0
+            self.active.append(item.key)
+        self.weights[item.key] = weight
+        self.queues[item.key].append(item)
+
+    def oldest(self) -> float:
+        return min(self.queues[key][0].enqueued for key in self.active)
+
+    def get(self) -> FairItem:
+        key = self.active[0]
+        item = self.queues[key].popleft()
+        self.deficits[key] += 1
+
+        if not self.queues[key]:
+            self._remove_key(key)
+        elif self.deficits[key] >= self.weights[key]:
+            self.deficits[key] = 0
+            self.active.rotate(-1)
+
+        return item
+
+    def remove(self, item: FairItem) -> None:
+        queue = self.queues.get(item.key)
+        if queue is None or item not in queue:
+            return
+
+        queue.remove(item)
+        if not queue:
+            self._remove_key(item.key)
+
+    def _remove_key(self, key: Hashable) -> None:
+        self.active.remove(key)
+        del self.queues[key]
+        del self.weights[key]
+        del self.deficits[key]
 
 
 class PrioritySemaphore:
-    def __init__(self, value: int = 1):
+    # All state is only touched from the event loop thread, so no lock is
+    # needed. A released slot is handed directly to the next waiter.
+    def __init__(
+        self,
+        value: int = 1,
+        fair: bool = False,
+        aging_interval: float = 60,
+    ):
         self._limit = value
         self._count = 0
         self._sequence = 0
-        self._queue: asyncio.PriorityQueue[PriorityItem] = asyncio.PriorityQueue()
-        self._lock = asyncio.Lock()
+        self._waiters = 0
+        self._heap: list[PriorityItem] = []
+        # In fair mode each priority has its own round robin over keys, and
+        # waiters gain one priority level per aging interval spent waiting
+        self._fair = fair
+        self._aging_interval = aging_interval
+        self._fair_queues: dict[int, FairQueue] = {}
 
     @property
-    async def is_full(self) -> bool:
-        async with self._lock:
-            return self._count >= self._limit
+    def waiters(self) -> int:
+        return self._waiters
+
+    def locked(self) -> bool:
+        return self._count >= self._limit
 
     @asynccontextmanager
-    async def acquire(self, priority: int = 0):
-        async with self._lock:
-            if self._count < self._limit:
-                self._count += 1
-                acquired_immediately = True
+    async def acquire(
+        self,
+        priority: int = 0,
+        key: Hashable = None,
+        weight: int = 1,
+    ):
+        if self._count < self._limit:
+            self._count += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            if self._fair:
+                item = FairItem(key=key, enqueued=time.monotonic(), future=future)
+                self._fair_queues.setdefault(priority, FairQueue()).put(item, weight)
             else:
-                acquired_immediately = False
-                event = asyncio.Event()
                 self._sequence += 1
                 item = PriorityItem(
-                    priority=priority, sequence=self._sequence, event=event
+                    priority=priority, sequence=self._sequence, future=future
                 )
-                await self._queue.put(item)
+                heapq.heappush(self._heap, item)
+            self._waiters += 1
 
-        if not acquired_immediately:
             try:
-                await event.wait()
+                await future
             except asyncio.CancelledError:
-                # If cancelled while waiting, check if we were already signaled
-                if event.is_set():
-                    # We got the semaphore, so we need to release it
-                    await self._release()
+                if future.done() and not future.cancelled():
+                    # The slot was handed to us before the cancellation
+                    # arrived, so pass it on
+                    self._release()
+                else:
+                    self._waiters -= 1
+                    self._discard(priority, item)
                 raise
 
         try:
             yield
         finally:
-            await self._release()
+            self._release()
+
+    def _discard(self, priority: int, item: PriorityItem | FairItem) -> None:
+        if self._fair:
+            self._fair_queues[priority].remove(item)
+        elif len(self._heap) > 2 * self._waiters:
+            # Cancelled waiters are skipped lazily on release, compact the
+            # heap once they make up most of it
+            self._heap = [queued for queued in self._heap if not queued.future.done()]
+            heapq.heapify(self._heap)
+
+    def _get_fair_item(self) -> FairItem | None:
+        now = time.monotonic()
+        selected = min(
+            (
+                (priority - (now - fair_queue.oldest()) / self._aging_interval, priority)
+                for priority, fair_queue in self._fair_queues.items()
+                if fair_queue
+            ),
+            default=None,
+        )
+        if selected is None:
+            return None
+
+        return self._fair_queues[selected[1]].get()
+
+    def _get_next_item(self) -> PriorityItem | FairItem | None:
+        while True:
+            if self._fair:
+                item = self._get_fair_item()
+            else:
+                item = heapq.heappop(self._heap) if self._heap else None
+            if item is None or not item.future.done():
+                return item
 
-    async def _release(self):
-        async with self._lock:
+    def _release(self) -> None:
+        item = self._get_next_item()
+        if item is None:
             self._count -= 1
-            if not self._queue.empty():
-                self._count += 1
-                item = self._queue.get_nowait()
-                item.event.set()
+        else:
+            self._waiters -= 1
+            item.future.set_result(None)
@@ -0,0 +1,106 @@
+import asyncio
+import contextvars
+import logging
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+from pyrogram.errors import FloodWait
+
+logger = logging.getLogger(__name__)
+
+CHAT_BURST = 3
+IDLE_BUCKET_SECONDS = 60
+MAX_CHAT_BUCKETS = 10000
+
+# Set while a call runs through the limiter, so clients raise FloodWait to it
+# instead of sleeping through the wait themselves and hiding it from the backoff
+rate_limited = contextvars.ContextVar("rate_limited", default=False)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.rate,
+        )
+        self.updated = now
+        self.tokens -= 1
+
+        delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(delay, self.blocked_until - now)
+
+    def on_success(self) -> None:
+        # Additive increase back towards the configured rate
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def on_flood_wait(self, seconds: float) -> None:
+        # Multiplicative decrease, plus a hard stop for the requested time
+        self.rate = max(self.max_rate / 16, self.rate / 2)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self, now: float) -> bool:
+        return now - self.updated > IDLE_BUCKET_SECONDS and now > self.blocked_until
+
+
+class RateLimiter:
+    def __init__(self, rate: float, chat_rate: float):
+        self.bucket = TokenBucket(rate, max(rate, 1))
+        self.chat_rate = chat_rate
+        # Keyed by chat ID, or by client and chat ID for clients other than
+        # the bot itself, since flood limits apply to each bot separately
+        self.chat_buckets: dict[Hashable, TokenBucket] = {}
+
+    def get_chat_bucket(self, chat_key: Hashable) -> TokenBucket:
+        chat_bucket = self.chat_buckets.get(chat_key)
+        if chat_bucket is None:
+            if len(self.chat_buckets) >= MAX_CHAT_BUCKETS:
+                self.prune()
+            chat_bucket = TokenBucket(self.chat_rate, CHAT_BURST)
+            self.chat_buckets[chat_key] = chat_bucket
+        return chat_bucket
+
+    def prune(self) -> None:
+        now = time.monotonic()
+        for chat_key, chat_bucket in list(self.chat_buckets.items()):
+            if chat_bucket.is_idle(now):
+                del self.chat_buckets[chat_key]
+
+    async def call(
+        self,
+        chat_key: Hashable | None,
+        function: Callable[..., Awaitable[Any]],
+        /,
+        *args,
+        **kwargs,
+    ) -> Any:
+        buckets = [self.bucket]
+        if chat_key is not None:
+            buckets.append(self.get_chat_bucket(chat_key))
+
+        while True:
+            delay = max(bucket.reserve() for bucket in buckets)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            token = rate_limited.set(True)
+            try:
+                result = await function(*args, **kwargs)
+            except FloodWait as e:
+                logger.warning(f"Flood wait of {e.value}s for chat {chat_key}")
+                buckets[-1].on_flood_wait(e.value)
+                continue
+            finally:
+                rate_limited.reset(token)
+
+            for bucket in buckets:
+                bucket.on_success()
+            return result
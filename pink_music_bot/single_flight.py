@@ -0,0 +1,22 @@
+import asyncio
+from typing import Hashable
+
+
+class SingleFlight:
+    def __init__(self):
+        self.flights: dict[Hashable, asyncio.Future[None]] = {}
+        self.coalesced = 0
+
+    def join(self, key: Hashable) -> asyncio.Future[None] | None:
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            return flight
+
+        self.flights[key] = asyncio.get_running_loop().create_future()
+        return None
+
+    def finish(self, key: Hashable) -> None:
+        flight = self.flights.pop(key, None)
+        if flight is not None and not flight.done():
+            flight.set_result(None)
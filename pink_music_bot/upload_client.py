@@ -0,0 +1,179 @@
+import asyncio
+import contextvars
+import inspect
+import math
+import os
+from contextlib import contextmanager
+from pathlib import PurePath
+from typing import Any, BinaryIO, Callable, Iterator
+
+from pyrogram import Client, raw
+from pyrogram.session import Session
+
+from .rate_limiter import rate_limited
+
+UPLOAD_PART_SIZE = 512 * 1024
+UPLOAD_WORKERS_PER_CONNECTION = 4
+# Smaller files are uploaded by Pyrogram over a single media connection
+PARALLEL_UPLOAD_MIN_SIZE = 100 * 1024 * 1024
+
+# Set around a send call that can be retried, so the retries reuse the files
+# the first attempt saved instead of uploading them again
+saved_files = contextvars.ContextVar("saved_files", default=None)
+
+
+@contextmanager
+def reuse_saved_files() -> Iterator[None]:
+    token = saved_files.set({})
+    try:
+        yield
+    finally:
+        saved_files.reset(token)
+
+
+class UploadClient(Client):
+    def __init__(self, *args, upload_connections: int = 1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_connections = upload_connections
+
+    async def invoke(
+        self,
+        query: raw.core.TLObject,
+        retries: int = Session.MAX_RETRIES,
+        timeout: float = Session.WAIT_TIMEOUT,
+        sleep_threshold: float | None = None,
+    ) -> Any:
+        # Handlers keep Pyrogram's sleep_threshold, calls made through the
+        # rate limiter leave every FloodWait to its backoff
+        if sleep_threshold is None and rate_limited.get():
+            sleep_threshold = 0
+
+        return await super().invoke(query, retries, timeout, sleep_threshold)
+
+    async def save_file(
+        self,
+        path: str | BinaryIO,
+        file_id: int = None,
+        file_part: int = 0,
+        progress: Callable = None,
+        progress_args: tuple = (),
+    ) -> Any:
+        files = saved_files.get()
+        # Parts Telegram reports as missing are saved again with a file_id,
+        # those are always uploaded
+        if files is None or file_id is not None or not isinstance(
+            path, (str, PurePath)
+        ):
+            return await self.save_new_file(
+                path,
+                file_id,
+                file_part,
+                progress,
+                progress_args,
+            )
+
+        file_key = (self.name, str(path))
+        if file_key not in files:
+            files[file_key] = await self.save_new_file(
+                path,
+                file_id,
+                file_part,
+                progress,
+                progress_args,
+            )
+        return files[file_key]
+
+    async def save_new_file(
+        self,
+        path: str | BinaryIO,
+        file_id: int | None,
+        file_part: int,
+        progress: Callable | None,
+        progress_args: tuple,
+    ) -> Any:
+        if (
+            self.upload_connections <= 1
+            or file_id is not None
+            or not isinstance(path, (str, PurePath))
+            or os.path.getsize(path) < PARALLEL_UPLOAD_MIN_SIZE
+        ):
+            return await super().save_file(
+                path,
+                file_id,
+                file_part,
+                progress,
+                progress_args,
+            )
+
+        async with self.save_file_semaphore:
+            return await self.save_big_file_parallel(path, progress, progress_args)
+
+    async def save_big_file_parallel(
+        self,
+        path: str | PurePath,
+        progress: Callable | None,
+        progress_args: tuple,
+    ) -> raw.types.InputFileBig:
+        # Parts of a big file can be saved in any order, so they are spread
+        # over several media connections instead of the single one Pyrogram
+        # uses, and a failed part fails the upload instead of being skipped
+        file_size = os.path.getsize(path)
+        file_total_parts = math.ceil(file_size / UPLOAD_PART_SIZE)
+        file_id = self.rnd_id()
+        file_parts = iter(range(file_total_parts))
+        uploaded_parts = 0
+
+        async def upload_parts(session: Session) -> None:
+            nonlocal uploaded_parts
+            with open(path, "rb") as file:
+                for file_part in file_parts:
+                    file.seek(file_part * UPLOAD_PART_SIZE)
+                    await session.invoke(
+                        raw.functions.upload.SaveBigFilePart(
+                            file_id=file_id,
+                            file_part=file_part,
+                            file_total_parts=file_total_parts,
+                            bytes=file.read(UPLOAD_PART_SIZE),
+                        )
+                    )
+
+                    uploaded_parts += 1
+                    if progress:
+                        result = progress(
+                            min(uploaded_parts * UPLOAD_PART_SIZE, file_size),
+                            file_size,
+                            *progress_args,
+                        )
+                        if inspect.isawaitable(result):
+                            await result
+
+        sessions = [
+            Session(
+                self,
+                await self.storage.dc_id(),
+                await self.storage.auth_key(),
+                await self.storage.test_mode(),
+                is_media=True,
+            )
+            for _ in range(self.upload_connections)
+        ]
+        try:
+            await asyncio.gather(*(session.start() for session in sessions))
+            await asyncio.gather(
+                *(
+                    upload_parts(session)
+                    for session in sessions
+                    for _ in range(UPLOAD_WORKERS_PER_CONNECTION)
+                )
+            )
+        finally:
+            await asyncio.gather(
+                *(session.stop() for session in sessions),
+                return_exceptions=True,
+            )
+
+        return raw.types.InputFileBig(
+            id=file_id,
+            parts=file_total_parts,
+            name=os.path.basename(path),
+        )
@@ -0,0 +1,27 @@
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator
+
+from pyrogram import Client
+
+
+@dataclass
+class UploadSession:
+    client: Client
+    active: int = 0
+
+
+class UploadPool:
+    def __init__(self, clients: list[Client]):
+        self.sessions = [UploadSession(client) for client in clients]
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator[Client]:
+        # The total number of uploads is bounded by the upload semaphore, the
+        # pool only spreads them over the least loaded session
+        session = min(self.sessions, key=lambda session: session.active)
+        session.active += 1
+        try:
+            yield session.client
+        finally:
+            session.active -= 1
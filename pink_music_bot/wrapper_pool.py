@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator
+
+logger = logging.getLogger(__name__)
+
+HEALTH_CHECK_TIMEOUT = 5
+
+
+@dataclass
+class WrapperEndpoint:
+    address: str
+    active: int = 0
+    healthy: bool = True
+
+
+class WrapperPool:
+    def __init__(
+        self,
+        addresses: list[str],
+        concurrency: int = 1,
+        health_check_interval: int = 30,
+    ):
+        self.endpoints = [WrapperEndpoint(address) for address in addresses]
+        self.concurrency = concurrency
+        self.health_check_interval = health_check_interval
+        self.condition = asyncio.Condition()
+
+    def _pick(self) -> WrapperEndpoint | None:
+        # Unhealthy endpoints are only used when none are healthy, so
+        # downloads fail as before instead of waiting forever
+        candidates = [
+            endpoint for endpoint in self.endpoints if endpoint.healthy
+        ] or self.endpoints
+        available = [
+            endpoint
+            for endpoint in candidates
+            if endpoint.active < self.concurrency
+        ]
+        return min(available, key=lambda endpoint: endpoint.active, default=None)
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator[str]:
+        async with self.condition:
+            while (endpoint := self._pick()) is None:
+                await self.condition.wait()
+            endpoint.active += 1
+
+        try:
+            yield endpoint.address
+        finally:
+            # The slot is given back before waiting for the lock, so being
+            # cancelled again while waiting cannot leak it
+            endpoint.active -= 1
+            await asyncio.shield(self.notify())
+
+    async def notify(self) -> None:
+        async with self.condition:
+            self.condition.notify_all()
+
+    async def check(self, endpoint: WrapperEndpoint) -> None:
+        host, port = endpoint.address.rsplit(":", 1)
+        try:
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, int(port)),
+                timeout=HEALTH_CHECK_TIMEOUT,
+            )
+            writer.close()
+            await writer.wait_closed()
+            healthy = True
+        except (OSError, asyncio.TimeoutError):
+            healthy = False
+
+        if healthy != endpoint.healthy:
+            logger.warning(
+                f"Wrapper {endpoint.address} is "
+                f"{'healthy' if healthy else 'unhealthy'}"
+            )
+
+        async with self.condition:
+            endpoint.healthy = healthy
+            self.condition.notify_all()
+
+    async def run_health_checks(self) -> None:
+        while True:
+            await asyncio.gather(*(self.check(endpoint) for endpoint in self.endpoints))
+            await asyncio.sleep(self.health_check_interval)
@@ -0,0 +1,101 @@
+"""Acquire/release cost of PrioritySemaphore under contention.
+
+Compares the current heap of futures with the previous implementation, which
+took an asyncio.Lock around every acquire and release and woke waiters
+through an asyncio.PriorityQueue of Events.
+
+    python -m scripts.bench_priority_semaphore [--limit 4] [--rounds 3]
+"""
+
+import argparse
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+
+from pink_music_bot.priority_semaphore import PrioritySemaphore
+
+WAITER_COUNTS = (10, 100, 10_000)
+
+
+@dataclass(order=True)
+class LegacyPriorityItem:
+    priority: int
+    sequence: int
+    event: asyncio.Event = field(compare=False)
+
+
+class LegacyPrioritySemaphore:
+    # The non-fair path of PrioritySemaphore before the rewrite
+    def __init__(self, value: int = 1):
+        self._limit = value
+        self._count = 0
+        self._sequence = 0
+        self._queue: asyncio.PriorityQueue[LegacyPriorityItem] = (
+            asyncio.PriorityQueue()
+        )
+        self._lock = asyncio.Lock()
+
+    @asynccontextmanager
+    async def acquire(self, priority: int = 0):
+        async with self._lock:
+            if self._count < self._limit:
+                self._count += 1
+                acquired_immediately = True
+            else:
+                acquired_immediately = False
+                event = asyncio.Event()
+                self._sequence += 1
+                await self._queue.put(
+                    LegacyPriorityItem(priority, self._sequence, event)
+                )
+
+        if not acquired_immediately:
+            await event.wait()
+
+        try:
+            yield
+        finally:
+            await self._release()
+
+    async def _release(self):
+        async with self._lock:
+            self._count -= 1
+            if not self._queue.empty():
+                self._count += 1
+                self._queue.get_nowait().event.set()
+
+
+async def run_waiters(semaphore, waiters: int) -> float:
+    async def waiter(priority: int) -> None:
+        async with semaphore.acquire(priority):
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(waiter(index % 2) for index in range(waiters)))
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--limit", type=int, default=4)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"Semaphore of {args.limit}, best of {args.rounds} rounds")
+    for waiters in WAITER_COUNTS:
+        results = []
+        for semaphore_class in (LegacyPrioritySemaphore, PrioritySemaphore):
+            elapsed = min(
+                asyncio.run(run_waiters(semaphore_class(args.limit), waiters))
+                for _ in range(args.rounds)
+            )
+            results.append(elapsed / waiters * 1_000_000)
+        print(
+            f"{waiters:>6} waiters: legacy {results[0]:6.1f} us, "
+            f"current {results[1]:6.1f} us per acquire/release"
+        )
+
+
+if __name__ == "__main__":
+    main()
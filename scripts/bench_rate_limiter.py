@@ -0,0 +1,117 @@
+"""Album throughput with the old fixed sleeps versus the rate limiter.
+
+A fake Telegram client enforces a flood limit per chat and raises FloodWait
+when a chat goes over it. Each track is downloaded, uploaded to the cache
+chat and forwarded to the user, one after the other, so only the pacing
+differs between the modes. Time runs --scale times faster than real time.
+
+    python -m scripts.bench_rate_limiter [--tracks 20] [--albums 1]
+"""
+
+import argparse
+import asyncio
+import time
+
+from pyrogram.errors import FloodWait
+
+from pink_music_bot.rate_limiter import RateLimiter, TokenBucket
+
+# The old code slept this long after each wrapper download and each item
+FIXED_SLEEP = 5
+DOWNLOAD_TIME = 0.5
+UPLOAD_TIME = 1
+CACHE_CHAT_ID = -1
+RATE_LIMIT = 25
+CHAT_RATE_LIMIT = 1
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 3
+
+
+class FakeTelegram:
+    def __init__(self, scale: float):
+        self.scale = scale
+        self.chat_buckets: dict[int, TokenBucket] = {}
+        self.flood_waits = 0
+
+    def check_flood(self, chat_id: int) -> None:
+        chat_bucket = self.chat_buckets.setdefault(
+            chat_id,
+            TokenBucket(TELEGRAM_CHAT_RATE * self.scale, TELEGRAM_CHAT_BURST),
+        )
+        delay = chat_bucket.reserve()
+        if delay > 0:
+            # A rejected message does not use up the chat's quota
+            chat_bucket.tokens += 1
+            self.flood_waits += 1
+            flood_wait = FloodWait(value=1)
+            flood_wait.value = delay
+            raise flood_wait
+
+    async def send_audio(self, chat_id: int) -> None:
+        await asyncio.sleep(UPLOAD_TIME / self.scale)
+        self.check_flood(chat_id)
+
+    async def forward_messages(self, chat_id: int) -> None:
+        self.check_flood(chat_id)
+
+
+async def call_sleeping(function, *args) -> None:
+    # What Pyrogram does with a FloodWait below its sleep_threshold
+    while True:
+        try:
+            return await function(*args)
+        except FloodWait as e:
+            await asyncio.sleep(e.value)
+
+
+async def deliver_album(
+    mode: str,
+    telegram: FakeTelegram,
+    rate_limiter: RateLimiter,
+    chat_id: int,
+    tracks: int,
+) -> None:
+    scale = telegram.scale
+    for _ in range(tracks):
+        await asyncio.sleep(DOWNLOAD_TIME / scale)
+        if mode == "fixed":
+            await asyncio.sleep(FIXED_SLEEP / scale)
+            await call_sleeping(telegram.send_audio, CACHE_CHAT_ID)
+            await call_sleeping(telegram.forward_messages, chat_id)
+            await asyncio.sleep(FIXED_SLEEP / scale)
+        else:
+            await rate_limiter.call(CACHE_CHAT_ID, telegram.send_audio, CACHE_CHAT_ID)
+            await rate_limiter.call(chat_id, telegram.forward_messages, chat_id)
+
+
+async def run_mode(mode: str, tracks: int, albums: int, scale: float) -> None:
+    telegram = FakeTelegram(scale)
+    rate_limiter = RateLimiter(RATE_LIMIT * scale, CHAT_RATE_LIMIT * scale)
+    start = time.monotonic()
+    await asyncio.gather(
+        *(
+            deliver_album(mode, telegram, rate_limiter, chat_id, tracks)
+            for chat_id in range(1, albums + 1)
+        )
+    )
+    elapsed = (time.monotonic() - start) * scale
+    print(
+        f"{mode:>13}: {tracks * albums / elapsed * 60:6.1f} tracks/min, "
+        f"{telegram.flood_waits} flood waits"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tracks", type=int, default=20)
+    parser.add_argument("--albums", type=int, default=1)
+    parser.add_argument("--scale", type=float, default=20)
+    args = parser.parse_args()
+
+    print(f"{args.albums} album(s) of {args.tracks} tracks")
+    for mode in ("fixed", "rate_limiter"):
+        asyncio.run(run_mode(mode, args.tracks, args.albums, args.scale))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Big file upload time by number of media connections.
+
+Uploads a sparse file through UploadClient.save_file against fake media
+sessions. Each connection has its own bandwidth and every part pays a round
+trip, so the results show how uploads scale with UPLOAD_CONNECTIONS. One
+connection is Pyrogram's own save_file.
+
+    python -m scripts.bench_upload_connections [--size-mb 256]
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from scripts.fake_telegram import create_client, use_fake_media_sessions
+
+CONNECTION_COUNTS = (1, 2, 4, 8)
+
+
+async def upload(path: str, upload_connections: int) -> float:
+    client = create_client(upload_connections)
+    start = time.perf_counter()
+    await client.save_file(path)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--bandwidth-mb", type=float, default=64)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    use_fake_media_sessions(
+        latency=args.latency_ms / 1000,
+        bandwidth=args.bandwidth_mb * 1024 * 1024,
+    )
+    print(
+        f"Uploading {args.size_mb} MB at {args.bandwidth_mb:g} MB/s and "
+        f"{args.latency_ms:g} ms per connection"
+    )
+    with tempfile.TemporaryDirectory() as temp_path:
+        path = os.path.join(temp_path, "video.mp4")
+        with open(path, "wb") as f:
+            f.truncate(args.size_mb * 1024 * 1024)
+
+        for upload_connections in CONNECTION_COUNTS:
+            elapsed = asyncio.run(upload(path, upload_connections))
+            print(
+                f"{upload_connections} connection(s): {elapsed:5.2f} s, "
+                f"{args.size_mb / elapsed:6.1f} MB/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Peak RSS of uploading a staged file from BytesIO versus from its path.
+
+Each mode runs in its own process, so the peak resident set size of one does
+not hide the other. The upload goes through Pyrogram's save_file against fake
+media sessions, which measures only the bot's side of the upload.
+
+    python -m scripts.bench_upload_rss [--size-mb 1536]
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+from scripts.fake_telegram import create_client, use_fake_media_sessions
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def upload(mode: str, path: str) -> None:
+    use_fake_media_sessions()
+    client = create_client()
+    if mode == "bytesio":
+        with open(path, "rb") as f:
+            file = io.BytesIO(f.read())
+        file.name = os.path.basename(path)
+        await client.save_file(file)
+    else:
+        await client.save_file(path)
+
+
+def run_mode(mode: str, path: str) -> None:
+    rss_before = max_rss_mb()
+    asyncio.run(upload(mode, path))
+    print(f"{mode:>8}: peak RSS {rss_before:.0f} MB -> {max_rss_mb():.0f} MB")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=1536)
+    parser.add_argument("--mode", choices=("bytesio", "path"))
+    parser.add_argument("--path")
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.path)
+        return
+
+    with tempfile.TemporaryDirectory() as temp_path:
+        path = os.path.join(temp_path, "video.mp4")
+        with open(path, "wb") as f:
+            f.truncate(args.size_mb * 1024 * 1024)
+
+        print(f"Uploading a {args.size_mb} MB file")
+        for mode in ("bytesio", "path"):
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "scripts.bench_upload_rss",
+                    "--mode",
+                    mode,
+                    "--path",
+                    path,
+                ],
+                check=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
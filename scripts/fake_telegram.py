@@ -0,0 +1,77 @@
+import asyncio
+import functools
+from types import SimpleNamespace
+
+import pyrogram.methods.advanced.save_file
+
+import pink_music_bot.upload_client
+from pink_music_bot.upload_client import UploadClient
+
+
+class FakeStorage:
+    async def dc_id(self) -> int:
+        return 2
+
+    async def auth_key(self) -> bytes:
+        return bytes(256)
+
+    async def test_mode(self) -> bool:
+        return False
+
+
+class FakeMediaSession:
+    # Stands in for a media connection: requests are pipelined, so the
+    # latency of one part overlaps the others, but the parts share the
+    # bandwidth of the connection
+    def __init__(
+        self,
+        client,
+        dc_id: int,
+        auth_key: bytes,
+        test_mode: bool,
+        is_media: bool = False,
+        latency: float = 0,
+        bandwidth: float = 0,
+    ):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.transfer_lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def invoke(self, query, *args, **kwargs) -> bool:
+        if self.bandwidth:
+            async with self.transfer_lock:
+                await asyncio.sleep(len(query.bytes) / self.bandwidth)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return True
+
+
+def use_fake_media_sessions(latency: float = 0, bandwidth: float = 0) -> None:
+    session = functools.partial(
+        FakeMediaSession,
+        latency=latency,
+        bandwidth=bandwidth,
+    )
+    pyrogram.methods.advanced.save_file.Session = session
+    pink_music_bot.upload_client.Session = session
+
+
+def create_client(upload_connections: int = 1) -> UploadClient:
+    # Must be called inside the running event loop, which Pyrogram captures
+    client = UploadClient(
+        "bench",
+        api_id=1,
+        api_hash="0" * 32,
+        in_memory=True,
+        no_updates=True,
+        upload_connections=upload_connections,
+    )
+    client.storage = FakeStorage()
+    client.me = SimpleNamespace(is_premium=False)
+    return client
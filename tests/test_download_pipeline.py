@@ -0,0 +1,204 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from gamdl.interface import SongCodec
+from pyrogram.errors import UserIsBlocked
+
+from pink_music_bot.commands import download
+from pink_music_bot.disk_admission import DiskAdmission
+from pink_music_bot.rate_limiter import RateLimiter
+from pink_music_bot.single_flight import SingleFlight
+
+ITEM_COUNT = 8
+
+
+def create_download_item(index: int, flat_filter_result=None) -> SimpleNamespace:
+    return SimpleNamespace(
+        media_metadata={
+            "id": str(index),
+            "type": next(iter(download.SONG_MEDIA_TYPE)),
+            "attributes": {
+                "name": f"Song {index}",
+                "durationInMillis": 180_000,
+                "has4K": False,
+            },
+        },
+        flat_filter_result=flat_filter_result,
+        random_uuid=f"uuid-{index}",
+    )
+
+
+def create_context(tmp_path, message_reply) -> download.DownloadContext:
+    async def noop(*args, **kwargs):
+        pass
+
+    async def is_under_maintenance(message):
+        return False
+
+    bot = SimpleNamespace(
+        disk_admission=DiskAdmission(str(tmp_path)),
+        single_flight=SingleFlight(),
+        rate_limiter=RateLimiter(1000, 1000),
+        download_pipeline_size=1,
+        song_cache_chat_id=-1,
+        music_video_cache_chat_id=-2,
+        is_under_maintenance=is_under_maintenance,
+        forward_messages=noop,
+        db=SimpleNamespace(
+            user=SimpleNamespace(add_counters=lambda *args, **kwargs: None),
+            download_job=SimpleNamespace(delete=noop),
+        ),
+    )
+    return download.DownloadContext(
+        bot=bot,
+        message=SimpleNamespace(
+            chat=SimpleNamespace(id=1),
+            from_user=SimpleNamespace(id=1),
+            reply=message_reply,
+        ),
+        lp=lambda *path: ".".join(path),
+        user=SimpleNamespace(
+            id=1,
+            active_membership=True,
+            song_codec=SongCodec.AAC_LEGACY,
+            fourk_download=False,
+        ),
+        interface=None,
+        base_downloader=SimpleNamespace(cleanup_temp=lambda random_uuid: None),
+        song_downloader=None,
+        music_video_downloader=None,
+        downloader=None,
+    )
+
+
+@pytest.fixture
+def fake_transfers(monkeypatch):
+    downloaded = []
+
+    async def enqueue_download(bot, downloader, download_item, *args):
+        await asyncio.sleep(0)
+        downloaded.append(download_item.media_metadata["id"])
+        return download_item
+
+    async def upload_pipeline_item(context, pipeline_item):
+        try:
+            await asyncio.sleep(0.01)
+            pipeline_item.cache_chat_id = context.bot.song_cache_chat_id
+            pipeline_item.cache_message_ids.append(
+                int(pipeline_item.download_item.media_metadata["id"])
+            )
+        finally:
+            download.release_pipeline_item(context, pipeline_item)
+
+    monkeypatch.setattr(download, "enqueue_download", enqueue_download)
+    monkeypatch.setattr(download, "upload_pipeline_item", upload_pipeline_item)
+    return downloaded
+
+
+async def iter_download_queue(download_items):
+    yield download_items, list(range(len(download_items)))
+
+
+def test_failed_delivery_releases_items_held_by_stages(tmp_path, fake_transfers):
+    async def message_reply(text):
+        # Let the download and upload stages fill up and block first
+        await asyncio.sleep(0.05)
+        raise UserIsBlocked()
+
+    async def run():
+        context = create_context(tmp_path, message_reply)
+        download_items = [create_download_item(0, "excluded")] + [
+            create_download_item(index) for index in range(1, ITEM_COUNT)
+        ]
+
+        with pytest.raises(UserIsBlocked):
+            await download.process_download_queue(
+                context,
+                iter_download_queue(download_items),
+            )
+
+        assert len(fake_transfers) > 1
+        assert context.bot.disk_admission.reserved == 0
+        assert not context.bot.single_flight.flights
+
+    asyncio.run(run())
+
+
+def test_cancelled_batch_releases_items_held_by_stages(tmp_path, fake_transfers):
+    async def message_reply(text):
+        pass
+
+    async def run():
+        context = create_context(tmp_path, message_reply)
+        delivered = asyncio.Event()
+
+        async def forward_messages(*args, **kwargs):
+            delivered.set()
+            await asyncio.sleep(1)
+
+        context.bot.forward_messages = forward_messages
+        download_items = [create_download_item(index) for index in range(ITEM_COUNT)]
+
+        task = asyncio.create_task(
+            download.process_download_queue(
+                context,
+                iter_download_queue(download_items),
+            )
+        )
+        await delivered.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        assert context.bot.disk_admission.reserved == 0
+        assert not context.bot.single_flight.flights
+
+    asyncio.run(run())
+
+
+def test_cache_hits_are_delivered_before_the_next_download(
+    tmp_path,
+    monkeypatch,
+    fake_transfers,
+):
+    cached = object()
+    forwarded = []
+
+    def apply_cache_entry(context, pipeline_item, cache_messages, use_file_ids):
+        if pipeline_item.download_item.flat_filter_result is not cached:
+            return False
+        pipeline_item.cache_chat_id = context.bot.song_cache_chat_id
+        pipeline_item.cache_message_ids.append(
+            int(pipeline_item.download_item.media_metadata["id"])
+        )
+        return True
+
+    async def enqueue_download(bot, downloader, download_item, *args):
+        await asyncio.sleep(0.05)
+        fake_transfers.append((download_item.media_metadata["id"], list(forwarded)))
+        return download_item
+
+    async def message_reply(text):
+        pass
+
+    async def run():
+        context = create_context(tmp_path, message_reply)
+
+        async def forward_messages(chat_id, cache_chat_id, message_ids, **kwargs):
+            forwarded.extend(message_ids)
+
+        context.bot.forward_messages = forward_messages
+        download_items = [create_download_item(index, cached) for index in range(2)]
+        download_items.append(create_download_item(2))
+
+        assert await download.process_download_queue(
+            context,
+            iter_download_queue(download_items),
+        ) == (True, 0)
+        assert fake_transfers == [("2", [0, 1])]
+        assert forwarded == [0, 1, 2]
+
+    monkeypatch.setattr(download, "apply_cache_entry", apply_cache_entry)
+    monkeypatch.setattr(download, "enqueue_download", enqueue_download)
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+import asyncio
+import datetime
+
+from pink_music_bot.database import Database
+
+FREE_DAILY_CREDITS = 10
+
+
+async def create_database(tmp_path) -> Database:
+    database = await Database.create(f"sqlite+aiosqlite:///{tmp_path / 'bot.db'}")
+    await database.user.load(1, FREE_DAILY_CREDITS)
+    return database
+
+
+async def add_download_jobs(database: Database, count: int) -> list[int]:
+    return await database.download_job.add_batch(
+        "batch",
+        1,
+        1,
+        1,
+        "https://music.apple.com/us/album/a/1",
+        [str(index) for index in range(count)],
+    )
+
+
+def test_reserved_credits_are_refunded_once_after_a_crash(tmp_path):
+    async def run():
+        database = await create_database(tmp_path)
+        download_job_ids = await add_download_jobs(database, 5)
+
+        assert await database.user.reserve_credits(1, download_job_ids[:4]) == 6
+
+        # The process that reserved the credits is gone, the resumed batch
+        # only knows the jobs
+        await database.download_job.delete(download_job_ids[:1])
+        assert (
+            await database.user.refund_credits(1, download_job_ids, FREE_DAILY_CREDITS)
+            == 9
+        )
+        assert (
+            await database.user.refund_credits(1, download_job_ids, FREE_DAILY_CREDITS)
+            == 9
+        )
+
+    asyncio.run(run())
+
+
+def test_refund_after_refresh_is_capped_at_daily_credits(tmp_path):
+    async def run():
+        database = await create_database(tmp_path)
+        download_job_ids = await add_download_jobs(database, 6)
+
+        assert await database.user.reserve_credits(1, download_job_ids[:4]) == 6
+
+        async with database.get_session() as session:
+            await database.user.refresh_free_credits(
+                session,
+                1,
+                FREE_DAILY_CREDITS,
+                datetime.datetime.now() + datetime.timedelta(days=1),
+            )
+        assert await database.user.reserve_credits(1, download_job_ids[4:]) == 8
+
+        assert (
+            await database.user.refund_credits(1, download_job_ids, FREE_DAILY_CREDITS)
+            == FREE_DAILY_CREDITS
+        )
+
+    asyncio.run(run())